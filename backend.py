@@ -1,20 +1,37 @@
 #!/usr/bin/python
 
-from flask import Flask, request, abort, send_from_directory, json, current_app
+from flask import Flask, request, abort, send_from_directory, current_app, stream_with_context
 from bson import json_util
 from bson.dbref import DBRef
+from bson.errors import InvalidId
 
 from werkzeug.exceptions import default_exceptions
 from werkzeug.exceptions import HTTPException
 from werkzeug.wsgi import wrap_file
+from werkzeug.http import parse_range_header, quote_etag, http_date
+
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 from mongokit import ObjectId
 from flask.ext.mongokit import MongoKit
-from documents import Job, App, AppStoreApp, CydiaApp, Run, Result, Worker, Account, Device
+from documents import BackendDocument, Job, App, AppStoreApp, CydiaApp, Run, Result, Worker, Account, Device, CriteriaSummary, StrategyRollup, StrategyHttpRequest, Counter, Upload, Blob, lookupCache
 
 import logging
 import base64
+import collections
+import functools
+import hashlib
+import itertools
 import os
+import threading
+import time
+import zlib
+
+# use simplejson (C speedups) for encoding when installed
+try:
+	import simplejson as jsonbackend
+except ImportError:
+	import json as jsonbackend
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('Backend')
@@ -28,23 +45,192 @@ logger = logging.getLogger('Backend')
 __all__ = ['make_json_app']
 
 
+def _json_default(obj):
+	""" encodes the bson types of our documents like json_util.default """
+	objType = type(obj)
+	if objType is ObjectId:
+		return {'$oid': str(obj)}
+	if objType is DBRef:
+		# the id is encoded by a nested call
+		return obj.as_doc()
+	return json_util.default(obj)
+
+# a single encoder instance avoids setting up an encoder per call
+_json_encoder = jsonbackend.JSONEncoder(default=_json_default)
+
 def jd(obj):
-	return json.dumps(obj, default=json_util.default)
+	return _json_encoder.encode(obj)
 
 def jl(obj):
-	return json.loads(obj, object_hook=json_util.object_hook)
+	return jsonbackend.loads(obj, object_hook=json_util.object_hook)
 
 #
 # Response
 #
-def response(data={}, code=200):
-	return (jd(data), code, {'Content-Type':'application/json'})
+def response(data={}, code=200, headers={}):
+	return response_json(jd(data), code, headers)
+
+def response_json(body, code=200, headers={}):
+	responseHeaders = {'Content-Type':'application/json'}
+	responseHeaders.update(headers)
+	return (body, code, responseHeaders)
+
+def jd_raw_doc(docClass, rawDoc, refValues={}):
+	""" encodes a raw document like clean_raw_doc would clean it; _id and
+		references are replaced while encoding instead of copying the document
+	"""
+	items = docClass.concrete_class(rawDoc).iter_clean_items(rawDoc, refValues)
+	return '{%s}' % ','.join('%s:%s' % (jd(key), jd(value)) for key, value in items)
 
 def response_doc(doc):
 	return response(doc.clean_doc())
 
-def response_doc_list(docList, dictKey='_id'):
-	return response(dict((str(doc[dictKey]), doc.clean_doc()) for doc in docList))
+def response_raw_doc(docClass, query, notFoundMessage='No document found'):
+	""" single document response read without dereferencing its references
+		(referenced keys other than ids are resolved with one query each)
+	"""
+	rawDoc = docClass.collection.find_one(query)
+	if not rawDoc:
+		abort(404, notFoundMessage)
+	return response_json(jd_raw_doc(docClass, rawDoc, docClass.resolve_ref_values(db, [rawDoc])))
+
+def response_doc_query(docClass, query, dictKey='_id', notFoundMessage='No results found for given criteria'):
+	""" list response for the documents matching query
+
+		supports keyset pagination and projection via request params:
+			after - id of the last document of the previous page
+			limit - max number of documents
+			sort - _id or date_added (prefix with - for descending order)
+			fields - comma separated list of fields to return
+		the id to continue with is returned via the X-Next-After header
+	"""
+	sortKey = request.values.get('sort', '_id')
+	direction = 1
+	if sortKey.startswith('-'):
+		direction = -1
+		sortKey = sortKey[1:]
+	if sortKey not in ('_id', 'date_added'):
+		abort(400, 'unsupported sort key %s' % sortKey)
+
+	after = get_objectid_param('after')
+	if after:
+		op = '$gt' if direction == 1 else '$lt'
+		if sortKey == '_id':
+			keyQuery = {'_id': {op: after}}
+		else:
+			lastDoc = docClass.collection.find_one({'_id': after}, {sortKey: 1})
+			if not lastDoc:
+				abort(400, 'unknown document %s for parameter after' % after)
+			keyQuery = {'$or': [
+				{sortKey: {op: lastDoc.get(sortKey)}},
+				{sortKey: lastDoc.get(sortKey), '_id': {op: after}}
+			]}
+		query = {'$and': [query, keyQuery]}
+
+	fields = None
+	if 'fields' in request.values:
+		fields = dict((field, 1) for field in request.values['fields'].split(',') if field)
+		fields[dictKey] = 1
+		# keep the type field to pick the concrete document class
+		typeField = getattr(docClass, 'type_field', None)
+		if typeField:
+			fields[typeField] = 1
+
+	sort = [(sortKey, direction)]
+	if sortKey != '_id':
+		sort.append(('_id', direction))
+	cursor = docClass.collection.find(query, fields).sort(sort)
+	limit = get_int_param('limit')
+	if limit:
+		cursor = cursor.limit(limit)
+
+	if limit:
+		# a page is bounded by limit, build it in memory to know the next id
+		rawDocs = list(cursor)
+		if not rawDocs:
+			abort(404, notFoundMessage)
+
+		headers = {}
+		if len(rawDocs) == limit:
+			headers['X-Next-After'] = str(rawDocs[-1]['_id'])
+		refValues = docClass.resolve_ref_values(db, rawDocs)
+		body = '{%s}' % ','.join('%s:%s' % (jd(str(rawDoc[dictKey])), jd_raw_doc(docClass, rawDoc, refValues)) for rawDoc in rawDocs)
+		return response_json(body, headers=headers)
+
+	# stream everything else straight from the cursor
+	firstDoc = next(cursor, None)
+	if not firstDoc:
+		abort(404, notFoundMessage)
+	rawDocs = itertools.chain([firstDoc], cursor)
+	return response_object_stream((rawDoc[dictKey], encoded) for rawDoc, encoded in _iter_encoded_raw_docs(docClass, rawDocs))
+
+def _iter_encoded_raw_docs(docClass, rawDocs, batchSize=100):
+	""" yields (rawDoc, json) pairs, references are resolved per batch """
+	for batch in _iter_batches(rawDocs, batchSize):
+		refValues = docClass.resolve_ref_values(db, batch)
+		for rawDoc in batch:
+			yield rawDoc, jd_raw_doc(docClass, rawDoc, refValues)
+
+def _iter_batches(items, batchSize):
+	batch = []
+	for item in items:
+		batch.append(item)
+		if len(batch) >= batchSize:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+def _buffered(chunks, bufferSize=64 * 1024):
+	""" joins small chunks to avoid a write per json fragment """
+	buf = []
+	size = 0
+	for chunk in chunks:
+		buf.append(chunk)
+		size += len(chunk)
+		if size >= bufferSize:
+			yield ''.join(buf)
+			buf = []
+			size = 0
+	if buf:
+		yield ''.join(buf)
+
+def response_stream(records, ndjson=False):
+	""" streams an iterable of records as chunked JSON array
+		or as newline delimited JSON (one record per line)
+	"""
+	def generate():
+		if ndjson:
+			for record in records:
+				yield jd(record) + '\n'
+		else:
+			yield '['
+			first = True
+			for record in records:
+				if not first:
+					yield ','
+				first = False
+				yield jd(record)
+			yield ']'
+	mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+	return current_app.response_class(stream_with_context(_buffered(generate())), mimetype=mimetype)
+
+def response_object_stream(items):
+	""" streams (key, json) pairs of JSON encoded values as chunked JSON object
+		keys are converted to str like the dict based responses
+	"""
+	def generate():
+		yield '{'
+		first = True
+		for key, value in items:
+			if not first:
+				yield ','
+			first = False
+			yield jd(str(key))
+			yield ':'
+			yield value
+		yield '}'
+	return current_app.response_class(stream_with_context(_buffered(generate())), mimetype='application/json')
 
 def response_file(fileobj, filename=None, cache_for=31536000, mimetype=None):
 	if not mimetype:
@@ -54,22 +240,325 @@ def response_file(fileobj, filename=None, cache_for=31536000, mimetype=None):
 	headers = {}
 	if filename:
 		headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
-	data = wrap_file(request.environ, fileobj, buffer_size=1024 * 256)
+
+	# files stored gzip encoded are passed through if the client accepts gzip
+	decode = False
+	contentEncoding = getattr(fileobj, 'contentEncoding', None)
+	if contentEncoding:
+		headers['Vary'] = 'Accept-Encoding'
+		if request.accept_encodings[contentEncoding]:
+			headers['Content-Encoding'] = contentEncoding
+		else:
+			decode = True
+
+	if decode:
+		data = _iter_gunzip(fileobj)
+	else:
+		data = wrap_file(request.environ, fileobj, buffer_size=1024 * 256)
 	response = current_app.response_class(
 		data,
 		mimetype=mimetype,
 		headers=headers,
 		direct_passthrough=True)
 
-	response.content_length = fileobj.length
+	if decode:
+		response.content_length = getattr(fileobj, 'originalLength', None)
+	else:
+		response.content_length = fileobj.length
+		response.headers['Accept-Ranges'] = 'bytes'
 	response.last_modified = fileobj.upload_date
-	response.set_etag(fileobj.md5)
+	if decode:
+		# another representation than the stored one
+		response.set_etag(fileobj.md5 + '-identity')
+	else:
+		response.set_etag(fileobj.md5)
 	response.cache_control.max_age = cache_for
 	response.cache_control.s_max_age = cache_for
 	response.cache_control.public = True
 	response.make_conditional(request)
+	if response.status_code == 200 and not decode:
+		_make_range_response(response, fileobj)
 	return response
 
+def _make_range_response(response, fileobj):
+	""" turns a full file response into a partial one (206) if a single
+		byte range was requested; multiple ranges get the full file
+	"""
+	byteRange = parse_range_header(request.headers.get('Range'))
+	if not byteRange or len(byteRange.ranges) != 1:
+		return
+	# If-Range: only send a part if the file is unchanged
+	ifRange = request.headers.get('If-Range')
+	if ifRange and ifRange not in (quote_etag(fileobj.md5), http_date(fileobj.upload_date)):
+		return
+
+	span = byteRange.range_for_length(fileobj.length)
+	if span is None:
+		response.response = []
+		response.status_code = 416
+		response.content_length = 0
+		response.headers['Content-Range'] = 'bytes */%d' % fileobj.length
+		return
+
+	start, stop = span
+	response.response = _iter_file_range(fileobj, start, stop - start)
+	response.status_code = 206
+	response.content_length = stop - start
+	response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, fileobj.length)
+
+def _iter_file_range(fileobj, start, length, bufferSize=1024 * 256):
+	# gridfs seeks to the chunk containing start without reading the preceding chunks
+	fileobj.seek(start)
+	while length > 0:
+		chunk = fileobj.read(min(bufferSize, length))
+		if not chunk:
+			break
+		length -= len(chunk)
+		yield chunk
+
+#
+# Compression
+#
+def _compressor(encoding):
+	# gzip or zlib (http deflate) framing
+	if encoding == 'gzip':
+		return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+
+def _accepted_encoding():
+	return request.accept_encodings.best_match(['gzip', 'deflate'])
+
+def _iter_compressed(chunks, encoding):
+	compressor = _compressor(encoding)
+	try:
+		for chunk in chunks:
+			data = compressor.compress(chunk)
+			if data:
+				yield data
+		yield compressor.flush()
+	finally:
+		if hasattr(chunks, 'close'):
+			chunks.close()
+
+def _iter_gunzip(fileobj, bufferSize=1024 * 256):
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	while True:
+		chunk = fileobj.read(bufferSize)
+		if not chunk:
+			break
+		data = decompressor.decompress(chunk)
+		if data:
+			yield data
+	yield decompressor.flush()
+
+def compress_json_response(response):
+	""" gzip/deflate encodes json responses if accepted by the client
+		(streamed responses always, others above COMPRESS_JSON_MIN_SIZE)
+	"""
+	if not current_app.config.get('COMPRESS_JSON', True):
+		return response
+	if response.direct_passthrough or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+		return response
+	if response.mimetype not in ('application/json', 'application/x-ndjson'):
+		return response
+	response.vary.add('Accept-Encoding')
+	encoding = _accepted_encoding()
+	if not encoding:
+		return response
+
+	if response.is_streamed:
+		response.response = _iter_compressed(response.response, encoding)
+		if 'Content-Length' in response.headers:
+			del response.headers['Content-Length']
+	else:
+		data = response.data
+		if len(data) < current_app.config.get('COMPRESS_JSON_MIN_SIZE', 1024):
+			return response
+		compressor = _compressor(encoding)
+		response.data = compressor.compress(data) + compressor.flush()
+	response.headers['Content-Encoding'] = encoding
+	# the encoded representation needs its own strong etag
+	etag, weak = response.get_etag()
+	if etag and not weak:
+		response.set_etag('%s-%s' % (etag, encoding))
+	return response
+
+#
+# Request parameters
+#
+def get_int_param(name, default=None, params=None):
+	if params is None:
+		params = request.values
+	if name not in params:
+		return default
+	try:
+		return int(params[name])
+	except ValueError:
+		abort(400, 'invalid integer for parameter %s' % name)
+
+def get_objectid_param(name, default=None):
+	if name not in request.values:
+		return default
+	try:
+		return ObjectId(request.values[name])
+	except InvalidId:
+		abort(400, 'invalid id for parameter %s' % name)
+
+#
+# Bulk writes
+#
+def bulk_insert(collection, rawDocs):
+	""" inserts the documents with a single unordered bulk write, a failing
+		document (e.g. a duplicate _id) does not stop the others
+		returns a dict index -> error message of the documents not inserted
+	"""
+	bulk = collection.initialize_unordered_bulk_op()
+	for rawDoc in rawDocs:
+		rawDoc.setdefault('_id', ObjectId())
+		bulk.insert(rawDoc)
+	try:
+		bulk.execute()
+	except BulkWriteError as e:
+		errors = {}
+		for error in e.details.get('writeErrors', []):
+			errors[error['index']] = error.get('errmsg', 'insert failed')
+		if e.details.get('writeConcernErrors'):
+			logger.error(e.details['writeConcernErrors'])
+		return errors
+	return {}
+
+#
+# Uploads
+#
+UPLOAD_CHUNK_SIZE = 1024 * 256
+
+def write_stream_to_fs(fs, filename, stream, hashes=(), compress=False):
+	""" copies a file like object into a new gridfs file in fixed-size
+		chunks, updating the given hashlib objects on the way
+		with compress the file is stored gzip encoded (see response_file)
+		an incomplete file is removed if reading or writing fails
+	"""
+	f = fs.new_file(filename)
+	compressor = None
+	if compress:
+		compressor = _compressor('gzip')
+		f.contentEncoding = 'gzip'
+	length = 0
+	try:
+		while True:
+			chunk = stream.read(UPLOAD_CHUNK_SIZE)
+			if not chunk:
+				break
+			length += len(chunk)
+			for h in hashes:
+				h.update(chunk)
+			if compressor:
+				chunk = compressor.compress(chunk)
+			f.write(chunk)
+		if compressor:
+			f.write(compressor.flush())
+			f.originalLength = length
+		f.close()
+	except Exception:
+		f.close()
+		fs.delete(f._id)
+		raise
+	return f
+
+#
+# Blob storage
+#
+# gridfs files are stored content addressed (see documents.Blob) and
+# accessed by name, files stored by name only are still found
+
+def blob_exists(doc, name):
+	if db.Blob.find_by_name(doc.__collection__, name):
+		return True
+	return doc.fs.exists({'filename': name})
+
+def blob_get(doc, name):
+	""" returns the gridfs file stored under name or None """
+	blob = db.Blob.find_by_name(doc.__collection__, name)
+	if blob:
+		return doc.fs.get(blob['file'])
+	if doc.fs.exists({'filename': name}):
+		return doc.fs.get_last_version(filename=name)
+	return None
+
+def blob_register(doc, name, f, sha256):
+	""" stores the new gridfs file f with the given sha256 under name
+		f is removed if the same content is already stored
+	"""
+	store = doc.__collection__
+	if db.Blob.link(store, sha256, name):
+		doc.fs.delete(f._id)
+		return
+	blob = db.Blob()
+	blob.update({
+		'store': store,
+		'sha256': sha256,
+		'file': f._id,
+		'length': f.length,
+		'refs': [name]
+	})
+	try:
+		blob.save()
+	except DuplicateKeyError:
+		# the same content was stored concurrently
+		doc.fs.delete(f._id)
+		db.Blob.link(store, sha256, name)
+
+def blob_write_data(doc, name, data, compress=False):
+	sha256 = hashlib.sha256(data).hexdigest()
+	if db.Blob.link(doc.__collection__, sha256, name):
+		return
+	f = doc.fs.new_file('blob')
+	if compress:
+		compressor = _compressor('gzip')
+		f.contentEncoding = 'gzip'
+		f.originalLength = len(data)
+		data = compressor.compress(data) + compressor.flush()
+	f.write(data)
+	f.close()
+	blob_register(doc, name, f, sha256)
+
+def blob_write_stream(doc, name, stream, sha256=None, compress=False, verified=False):
+	""" stores the stream under name, a given sha256 is checked against the content
+		verified - sha256 was computed by the server (or a trusted client),
+		if the content is already stored the stream is not read at all
+	"""
+	if sha256:
+		sha256 = sha256.lower()
+		if verified and db.Blob.link(doc.__collection__, sha256, name):
+			return
+	h = hashlib.sha256()
+	f = write_stream_to_fs(doc.fs, 'blob', stream, [h], compress)
+	if sha256 and h.hexdigest() != sha256:
+		doc.fs.delete(f._id)
+		raise ValueError('checksum mismatch')
+	blob_register(doc, name, f, h.hexdigest())
+
+def blob_delete(doc, name):
+	""" removes name, the content is removed with its last name
+		returns False if there is no file of that name
+	"""
+	found = False
+	if db.Blob.find_by_name(doc.__collection__, name):
+		found = True
+		fileId = db.Blob.unlink(doc.__collection__, name)
+		if fileId:
+			doc.fs.delete(fileId)
+	# files stored by name only
+	while doc.fs.exists({'filename': name}):
+		found = True
+		doc.fs.delete(doc.fs.get_last_version(filename=name)._id)
+	return found
+
+# clients may be trusted to send the correct sha256 of their content,
+# which allows to link stored content without receiving it again
+def trust_client_sha256():
+	return app.config.get('TRUST_CLIENT_SHA256', False)
+
 def make_json_app(import_name, **kwargs):
 	"""
 	Creates a JSON-oriented Flask app.
@@ -120,10 +609,16 @@ if AABACKEND_SETTINGS_ENV_KEY in os.environ:
 else:
 	app.config.from_pyfile('backend.cfg')
 
+app.after_request(compress_json_response)
+
+lookupCache.configure(app.config.get('LOOKUP_CACHE_SIZE', 256), app.config.get('LOOKUP_CACHE_TTL', 60))
+
 # connect to the database
 #db = Connection(Model.config.get('backend', 'dburi'))
 db = MongoKit(app)
-db.register([Worker, Job, App, AppStoreApp, CydiaApp, Run, Result, Account, Device])
+# references (DBRefs) name the configured database, e.g. the one of the tests
+BackendDocument.__database__ = app.config['MONGODB_DATABASE']
+db.register([Worker, Job, App, AppStoreApp, CydiaApp, Run, Result, Account, Device, CriteriaSummary, StrategyRollup, StrategyHttpRequest, Counter, Upload, Blob])
 
 # This will prevent errors due to missing dbref info
 # just instantiate each document once
@@ -133,6 +628,16 @@ with app.app_context():
 		db[doc.__name__]()
 
 
+# create the declared indexes of all documents (or only the required ones)
+def ensure_indexes(requiredOnly=False):
+	for doc in db.registered_documents:
+		if doc.indexes_required or not requiredOnly:
+			doc.ensure_indexes(getattr(db, doc.__name__).collection)
+
+with app.app_context():
+	ensure_indexes(requiredOnly=not app.config.get('ENSURE_INDEXES', False))
+
+
 ###
 ### REST API
 ###
@@ -151,32 +656,25 @@ def serve_frontend(filepath='index.html'):
 
 @app.route('/apps', methods=["GET"])
 def get_apps():
-	appList = []
-	appList += db.AppStoreApp.fetch({'type': 'AppStoreApp'})
-	appList += db.CydiaApp.fetch({'type': 'CydiaApp'})
-	if not appList or len(appList) == 0:
-		abort(404, 'No apps found')
-
-	return response_doc_list(appList, '_id')
+	query = {'type': {'$in': ['AppStoreApp', 'CydiaApp']}}
+	return response_doc_query(db.App, query, '_id', 'No apps found')
 
 
 def _get_apps_id_doc(objid):
 	app = None
 	try:
-		app = db.AppStoreApp.fetch_one({'_id':objid, 'type': 'AppStoreApp'})
-		if not app:
-			app = db.CydiaApp.fetch_one({'_id':objid, 'type': 'CydiaApp'})
-		if not app:
-			abort(404, 'No apps found')
+		app = App.find_one_concrete(db, {'_id':objid})
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	if not app:
+		abort(404, 'No apps found')
 	return app
 
 
 @app.route('/apps/<ObjectId:objid>', methods=["GET"])
 def get_apps_id(objid):
-	return response_doc(_get_apps_id_doc(objid))
+	return response_raw_doc(db.App, {'_id': objid}, 'No apps found')
 
 
 @app.route('/apps/bundleid/<bundleId>', methods=["GET"])
@@ -186,23 +684,17 @@ def get_apps_bundleId(bundleId):
 		query['version'] = request.values['version']
 	logger.debug('get app via bundleId. query: %s' % query)
 
-	appList = []
-	query['type'] = 'AppStoreApp'
-	appList += db.AppStoreApp.fetch(query)
-	query['type'] = 'CydiaApp'
-	appList += db.CydiaApp.fetch(query)
-	if not appList or len(appList) == 0:
-		abort(404, 'No app found for bundleId %s' % bundleId)
-	return response_doc_list(appList, '_id')
+	return response_doc_query(db.App, query, '_id', 'No app found for bundleId %s' % bundleId)
 
 
 @app.route('/apps/<ObjectId:objid>/ipa', methods=["GET"])
 def get_apps_ipa(objid):
 	app = _get_apps_id_doc(objid)
 	filename = str(objid)+'.ipa'
-	if not app.fs.exists({'filename': filename}):
+	ipaFile = blob_get(app, filename)
+	if not ipaFile:
 		abort(404, 'No ipa file found')
-	return response_file(app.fs.get_last_version(filename=filename), filename='%s.ipa' % app.bundleId)
+	return response_file(ipaFile, filename='%s.ipa' % app.bundleId)
 
 
 @app.route('/apps/<ObjectId:objid>/ipa', methods=["POST", "PUT"])
@@ -216,16 +708,20 @@ def post_apps_ipa(objid):
 	app = _get_apps_id_doc(objid)
 	filename = str(objid)+'.ipa'
 	
-	if app.fs.exists({'filename': filename}):
+	if blob_exists(app, filename):
 		abort(400, 'file already present')
 		
 	ipa = files.values()[0]
 	app.save()
 
-	f = app.fs.new_file(filename)
-	f.write(ipa)
-	f.close()
+	# hash the (spooled) file first, a known ipa is not stored again
+	sha256 = hashlib.sha256()
+	for chunk in iter(lambda: ipa.stream.read(UPLOAD_CHUNK_SIZE), ''):
+		sha256.update(chunk)
+	ipa.stream.seek(0)
+
 	try:
+		blob_write_stream(app, filename, ipa.stream, sha256.hexdigest(), verified=True)
 		app.save()
 	except Exception as e:
 		logger.error(e)
@@ -236,6 +732,197 @@ def post_apps_ipa(objid):
 		"appId": str(app['_id'])
 	})
 
+@app.route('/apps/<ObjectId:objid>/ipa', methods=["DELETE"])
+def delete_apps_ipa(objid):
+	app = _get_apps_id_doc(objid)
+	if not blob_delete(app, str(objid)+'.ipa'):
+		abort(404, 'No ipa file found')
+	return response({
+		"message": "OK"
+	})
+
+## resumable ipa upload
+#	POST /apps/<id>/ipa/uploads {"sha256": <hex>, "length": <bytes>} - start an upload
+#		(returns "complete": true instead if the same ipa is already stored
+#		and TRUST_CLIENT_SHA256 is set)
+#	GET /apps/<id>/ipa/uploads/<uploadId> - current offset of an upload
+#	PUT /apps/<id>/ipa/uploads/<uploadId>?offset=<bytes> - append the body at offset
+#	POST /apps/<id>/ipa/uploads/<uploadId>/finalize - verify and store the ipa
+#	DELETE /apps/<id>/ipa/uploads/<uploadId> - cancel an upload
+# abandoned uploads are removed by `manage.py expire-uploads`
+
+def _get_ipa_upload(objid, uploadId):
+	upload = db.Upload.find_one({'_id': uploadId, 'target': objid})
+	if not upload:
+		abort(404, 'No upload found')
+	return upload
+
+
+def _delete_upload_parts(fs, upload):
+	for part in upload.get('parts', []):
+		fs.delete(part['file'])
+
+
+def response_upload(upload):
+	return response({
+		"message": "OK",
+		"uploadId": str(upload['_id']),
+		"offset": upload['offset'],
+		"length": upload['length']
+	})
+
+
+@app.route('/apps/<ObjectId:objid>/ipa/uploads', methods=["POST"])
+def post_apps_ipa_uploads(objid):
+	app = _get_apps_id_doc(objid)
+	filename = str(objid)+'.ipa'
+	if blob_exists(app, filename):
+		abort(400, 'file already present')
+
+	data = request.json
+	if not data or not data.get('sha256'):
+		abort(400, 'sha256 of the file required')
+
+	# an already stored ipa is linked without any upload for trusted clients,
+	# otherwise the upload is deduplicated once it is hashed on finalize
+	if trust_client_sha256() and db.Blob.link(app.__collection__, str(data['sha256']).lower(), filename):
+		return response({
+			"message": "OK",
+			"appId": str(objid),
+			"complete": True
+		})
+
+	upload = db.Upload()
+	upload.update({
+		'target': objid,
+		'filename': filename,
+		'sha256': str(data['sha256']).lower(),
+		'length': data.get('length')
+	})
+	try:
+		upload.save()
+	except Exception as e:
+		logger.error(e)
+		abort(400, str(e))
+	return response_upload(upload)
+
+
+@app.route('/apps/<ObjectId:objid>/ipa/uploads/<ObjectId:uploadId>', methods=["GET"])
+def get_apps_ipa_uploads_id(objid, uploadId):
+	return response_upload(_get_ipa_upload(objid, uploadId))
+
+
+@app.route('/apps/<ObjectId:objid>/ipa/uploads/<ObjectId:uploadId>', methods=["PUT"])
+def put_apps_ipa_uploads_id(objid, uploadId):
+	app = _get_apps_id_doc(objid)
+	upload = _get_ipa_upload(objid, uploadId)
+	# from the query string only, request.values would parse a body sent
+	# with a form content type (e.g. by curl --data-binary) and empty the stream
+	offset = get_int_param('offset', params=request.args)
+	if offset != upload['offset']:
+		return response({
+			"message": "upload continues at offset %d" % upload['offset'],
+			"offset": upload['offset']
+		}, 409)
+	if upload['length'] is not None and request.content_length and offset + request.content_length > upload['length']:
+		abort(400, 'part exceeds the declared length of %d bytes' % upload['length'])
+
+	# store the chunk as separate part, completed parts survive dropped connections
+	try:
+		f = write_stream_to_fs(app.fs, '%s.upload_%s_%d' % (upload['filename'], uploadId, offset), request.stream)
+	except Exception as e:
+		logger.error(e)
+		abort(400, str(e))
+	if f.length == 0:
+		app.fs.delete(f._id)
+		return response_upload(upload)
+	# chunked requests have no content length
+	if upload['length'] is not None and offset + f.length > upload['length']:
+		app.fs.delete(f._id)
+		abort(400, 'part exceeds the declared length of %d bytes' % upload['length'])
+
+	# append the part only if no other request did so in the meantime
+	part = {'offset': offset, 'length': f.length, 'file': f._id}
+	db.Upload.collection.update(
+		{'_id': uploadId, 'offset': offset},
+		{'$inc': {'offset': f.length}, '$push': {'parts': part}})
+	upload = _get_ipa_upload(objid, uploadId)
+	if f._id not in [p['file'] for p in upload['parts']]:
+		app.fs.delete(f._id)
+		return response({
+			"message": "upload continues at offset %d" % upload['offset'],
+			"offset": upload['offset']
+		}, 409)
+	return response_upload(upload)
+
+
+@app.route('/apps/<ObjectId:objid>/ipa/uploads/<ObjectId:uploadId>/finalize', methods=["POST"])
+def post_apps_ipa_uploads_id_finalize(objid, uploadId):
+	app = _get_apps_id_doc(objid)
+	upload = _get_ipa_upload(objid, uploadId)
+	if upload['length'] is not None and upload['offset'] != upload['length']:
+		abort(400, 'upload incomplete (%d of %d bytes received)' % (upload['offset'], upload['length']))
+	if blob_exists(app, upload['filename']):
+		abort(400, 'file already present')
+
+	# join the parts into the ipa file, the file is visible once it is registered
+	sha256 = hashlib.sha256()
+	f = app.fs.new_file('blob')
+	try:
+		for part in sorted(upload['parts'], key=lambda p: p['offset']):
+			partFile = app.fs.get(part['file'])
+			while True:
+				chunk = partFile.read(UPLOAD_CHUNK_SIZE)
+				if not chunk:
+					break
+				sha256.update(chunk)
+				f.write(chunk)
+		if sha256.hexdigest() != upload['sha256']:
+			raise ValueError('checksum mismatch, upload discarded')
+		f.close()
+		blob_register(app, upload['filename'], f, upload['sha256'])
+	except Exception as e:
+		logger.error(e)
+		f.close()
+		app.fs.delete(f._id)
+		_delete_upload_parts(app.fs, upload)
+		upload.delete()
+		abort(400, str(e))
+
+	_delete_upload_parts(app.fs, upload)
+	upload.delete()
+	return response({
+		"message": "OK",
+		"appId": str(objid)
+	})
+
+
+@app.route('/apps/<ObjectId:objid>/ipa/uploads/<ObjectId:uploadId>', methods=["DELETE"])
+def delete_apps_ipa_uploads_id(objid, uploadId):
+	app = _get_apps_id_doc(objid)
+	upload = _get_ipa_upload(objid, uploadId)
+	_delete_upload_parts(app.fs, upload)
+	upload.delete()
+	return response({
+		"message": "OK"
+	})
+
+
+# removes the uploads started more than maxAge seconds ago and their parts
+# (see `manage.py expire-uploads`), returns the number of removed uploads
+def expire_uploads(maxAge):
+	count = 0
+	for upload in db.Upload.find({'date_added': {'$lt': time.time() - maxAge}}):
+		app = App.find_one_concrete(db, {'_id': upload['target']})
+		if app:
+			_delete_upload_parts(app.fs, upload)
+		else:
+			logger.error('app <%s> of upload <%s> not found, parts not removed' % (upload['target'], upload['_id']))
+		upload.delete()
+		count += 1
+	return count
+
+
 @app.route('/apps', methods=["POST"])
 @app.route('/apps/appstore', methods=["POST"])
 def post_apps_appstore():
@@ -258,6 +945,8 @@ def post_apps_appstore():
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	# the analytics contain the bundleId/genre of the apps
+	results_changed()
 	return response({
 		"message": "OK",
 		"appId": str(app['_id'])
@@ -275,12 +964,41 @@ def post_apps_cydia():
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	# the analytics contain the bundleId/genre of the apps
+	results_changed()
 	return response({
 		"message": "OK",
 		"appId": str(app['_id'])
 	})
 
 
+#
+#	Change counters
+#
+# Waiting requests poll a counter document to notice changes made by
+# other processes; within this process they are woken up immediately.
+
+COUNTER_POLL_INTERVAL = 0.5
+_counterCondition = threading.Condition()
+
+def increase_counter(name):
+	db.Counter.increase(name)
+	with _counterCondition:
+		_counterCondition.notify_all()
+
+# returns True if the counter changed before the timeout
+def wait_for_counter(name, value, timeout):
+	deadline = time.time() + timeout
+	while True:
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			return False
+		with _counterCondition:
+			_counterCondition.wait(min(COUNTER_POLL_INTERVAL, remaining))
+		if db.Counter.get_value(name) != value:
+			return True
+
+
 #
 #	Job
 #
@@ -298,25 +1016,44 @@ def get_jobs():
 	if 'bundleId' in request.values :
 		query['bundleId'] = request.values['bundleId']
 
-	cursor = db.Job.find(query)
-	if not cursor or cursor.count() == 0:
-		abort(404, 'No jobs found for given criteria')
+	return response_doc_query(db.Job, query, notFoundMessage='No jobs found for given criteria')
 
-	return response_doc_list(cursor)
 
 
+# query for the jobs the given worker/device may claim
+def job_claim_query(workerId, deviceId, accounts):
+	return {
+		"$and": [
+			{"$or": [
+				{"worker": {"$type":10}}, # worker has to be NULL
+				{"worker.$id": workerId} # or the current worker
+			]},
+			{"$or": [
+				{"device": {"$type":10}}, # device has to be NULL
+				{"device.$id": deviceId} # or the current device
+			]},
+			# only jobs able to run on the given device (accountId/storeCountry)
+			Job.device_query(accounts)
+		],
+		"state": {"$nin": [Job.STATE.FINISHED, Job.STATE.FAILED]}
+	}
 
 # this method will return a suitable job for given worker and device or fail with 204 if currently no job available
 @app.route('/jobs/getandsetworker/<ObjectId:workerId>/device/<deviceUDID>', methods=["GET"])
 def get_and_set_worker(workerId, deviceUDID):
 	jobFound = False
 
-	worker = db.Worker.get_or_404(workerId)
+	# workers and devices are polled frequently but rarely change
+	worker = lookupCache.find_one(db.Worker, '_id', workerId)
+	if not worker:
+		abort(404)
 	workerRef = DBRef(collection=worker.__collection__, id=workerId, database=worker.__database__)
 	# use this DBRef instead of the worker doc due to $set is unable to set documents
 #	logger.debug('worker found: %s' % str(worker['_id']))
 
-	device = db.Device.find_one_or_404({'udid': deviceUDID})
+	device = lookupCache.find_one(db.Device, 'udid', deviceUDID)
+	if not device:
+		abort(404)
 	deviceRef = DBRef(collection=device.__collection__, id=device['_id'], database=device.__database__)
 	# use this DBRef instead of the device doc due to $set is unable to set documents
 #	logger.debug('device found: %s' % str(device['_id']))
@@ -332,46 +1069,37 @@ def get_and_set_worker(workerId, deviceUDID):
 		logger.debug('found an unfinished job <%s> for device <%s>' % (str(job['_id']), str(device['_id'])))
 
 
-	query = {
-		"$or": [
-			{"worker": {"$type":10}}, # worker has to be NULL
-			{"worker.$id": workerId} # or the current worker
-		],
-		"$or": [
-			{"device": {"$type":10}}, # device has to be NULL
-			{"device.$id": device["_id"]} # or the current device
-		],
-		"state": {"$nin": [Job.STATE.FINISHED, Job.STATE.FAILED]},
-		"_id": {"$nin":[]} # job blacklist for jobs unable to run on the given device
-	}
+	if not jobFound:
+		query = job_claim_query(workerId, device['_id'], device.accounts)
 
-	while not jobFound:
-		# gat a job and set the worker within an atomic operation to guarantee consistency
-		job = db.Job.find_and_modify(query=query, update={'$set': {'worker':workerRef, 'device':deviceRef}}, sort=[('date_added',-1)], new=True)
+		# optionally wait up to <wait> seconds for a new job (long polling)
+		wait = min(get_int_param('wait', 0), app.config.get('JOB_WAIT_MAX', 60))
+		deadline = time.time() + wait
+		while not jobFound:
+			# read the counter first to not miss jobs added during the claim
+			jobCounter = db.Counter.get_value('jobs')
 
-		if not job or not '_id' in job:
-			return response(data={'message':'Currently no free job available'}, code=204)
+			# get a job and set the worker within an atomic operation to guarantee consistency
+			job = db.Job.find_and_modify(query=query, update={'$set': {'worker':workerRef, 'device':deviceRef}}, sort=[('date_added',-1)], new=True)
 
-		if job.can_run_on_device(device):
-			jobFound = True
-		else:
-			print "DEBUG: job is unable to run on device \njob: %s\ndevice: %s" % (job, device)
-			# reset the jobs worker entry
-			db.Job.collection.update({"_id":ObjectId(job['_id'])}, {"$set": {"worker":None, "device":None}})
-			# add the current job to the blacklist
-			query['_id']['$nin'].append(ObjectId(job['_id']))
+			if job and '_id' in job:
+				jobFound = True
+			elif not wait_for_counter('jobs', jobCounter, deadline - time.time()):
+				return response(data={'message':'Currently no free job available'}, code=204)
 
 	return response_doc(job)
 
 
 @app.route('/jobs/<ObjectId:objid>', methods=["GET"])
 def get_jobs_id(objid):
-	doc = db.Job.get_or_404(objid)
-	return response_doc(doc)
+	return response_raw_doc(db.Job, {'_id': objid})
 
 
 @app.route('/jobs', methods=["POST"])
 def post_jobs():
+	# a list of jobs is inserted in bulk
+	if isinstance(request.json, list):
+		return _post_jobs_list(request.json)
 
 	job = db.Job()
 	data = job.rebuild_doc_dict(db, request.json)
@@ -383,12 +1111,61 @@ def post_jobs():
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	# wake up waiting workers
+	increase_counter('jobs')
 	return response({
 		"message": "OK",
 		"jobId": str(job['_id'])
 	})
 
 
+def _post_jobs_list(dataList):
+	if not dataList:
+		abort(400, 'No data received')
+
+	# validate all jobs, the references are resolved with one query per collection
+	items = []
+	rawDocs = []
+	for data in db.Job.rebuild_doc_dicts(db, dataList):
+		item = {}
+		items.append(item)
+		job = db.Job()
+		try:
+			if not data:
+				raise ValueError('No data received')
+			job.update(data)
+			job.validate()
+		except Exception as e:
+			item['message'] = str(e)
+			continue
+		rawDoc = job.raw_doc()
+		item['doc'] = rawDoc
+		rawDocs.append(rawDoc)
+
+	# insert the valid jobs with a single bulk write
+	if rawDocs:
+		errors = bulk_insert(db.Job.collection, rawDocs)
+		insertedItems = [entry for entry in items if 'doc' in entry]
+		for index, message in errors.iteritems():
+			item = insertedItems[index]
+			del item['doc']
+			item['message'] = message
+		if len(errors) < len(rawDocs):
+			# wake up waiting workers
+			increase_counter('jobs')
+
+	jobs = []
+	for item in items:
+		if 'doc' in item:
+			jobs.append({"message": "OK", "jobId": str(item['doc']['_id'])})
+		else:
+			jobs.append({"message": item['message']})
+	return response({
+		"message": "OK",
+		"jobs": jobs
+	})
+
+
 #
 # Result
 #
@@ -400,16 +1177,12 @@ def get_results():
 	if 'resultType' in request.values:
 		query['resultInfo.type'] = request.values['resultType']
 
-	cursor = db.Result.find(query)
-	if not cursor or cursor.count() == 0:
-		abort(404, 'No results found for given criteria')
-	return response_doc_list(cursor)
+	return response_doc_query(db.Result, query)
 
 
 @app.route('/results/<ObjectId:objid>', methods=["GET"])
 def get_results_id(objid):
-	doc = db.Result.get_or_404(objid)
-	return response_doc(doc)
+	return response_raw_doc(db.Result, {'_id': objid})
 
 
 @app.route('/results/<ObjectId:objid>/binary', methods=["GET"])
@@ -420,158 +1193,417 @@ def get_results_id_apparchive(objid):
 		abort(404, 'result contains no %s binary' % resultType)
 
 	filename = '%s_%s' % (resultType, str(objid))
-	if not result.fs.exists({'filename': filename}):
+	binaryFile = blob_get(result, filename)
+	if not binaryFile:
 		abort(404, 'No file found')
 	fileExtension = ""
 	if resultType == Result.TYPE.APP_ARCHIVE:
 		fileExtension = "zip"
 	elif resultType == Result.TYPE.TCPDUMP:
 		fileExtension = "pcap"
-	return response_file(result.fs.get_last_version(filename=filename), filename='%s.%s' % (filename, fileExtension))
+	return response_file(binaryFile, filename='%s.%s' % (filename, fileExtension))
+
+
+# streams the request body (raw or a single multipart file) into gridfs
+# an X-Content-SHA256 header is checked against the received content, with
+# TRUST_CLIENT_SHA256 a known hash allows to skip the upload of stored content
+@app.route('/results/<ObjectId:objid>/binary', methods=["POST", "PUT"])
+def post_results_id_binary(objid):
+	result = db.Result.get_or_404(objid)
+	resultType = result.resultInfo.type
+	if not (resultType == Result.TYPE.APP_ARCHIVE or resultType == Result.TYPE.TCPDUMP):
+		abort(400, 'result of type %s has no binary' % resultType)
+
+	filename = '%s_%s' % (resultType, str(objid))
+	if blob_exists(result, filename):
+		abort(400, 'file already present')
+
+	stream = request.stream
+	if request.mimetype == 'multipart/form-data':
+		files = request.files
+		if len(files) != 1:
+			abort(400, 'invaild file data (please send exactly one file)')
+		stream = files.values()[0].stream
+
+	try:
+		blob_write_stream(result, filename, stream, request.headers.get('X-Content-SHA256'), _compress_result_binary(resultType), trust_client_sha256())
+	except Exception as e:
+		logger.error(e)
+		abort(400, str(e))
+
+	if result.resultInfo['data'] != resultType.upper():
+		result.resultInfo['data'] = resultType.upper()
+		result.save()
+
+	return response({
+		"message": "OK",
+		"resultId": str(objid)
+	})
+
+
+@app.route('/results/<ObjectId:objid>/binary', methods=["DELETE"])
+def delete_results_id_binary(objid):
+	result = db.Result.get_or_404(objid)
+	if not blob_delete(result, '%s_%s' % (result.resultInfo.type, str(objid))):
+		abort(404, 'No binary found')
+	return response({
+		"message": "OK"
+	})
 
 
 @app.route('/results', methods=["POST"])
 def post_results():
+	# a list of results (e.g. all results of a run) is inserted in bulk
+	if isinstance(request.json, list):
+		return _post_results_list(request.json)
+
 	result = db.Result()
 	data = result.rebuild_doc_dict(db, request.json)
 	if not data:
 		abort(400, 'No data received')
 	result.update(data)
 
-	# check for app_archive and save it to gridfs instead
-	if 'type' in result.resultInfo:
-		resultType = result.resultInfo['type']
-		if resultType == Result.TYPE.APP_ARCHIVE or resultType == Result.TYPE.TCPDUMP:
-	
-			data = result.resultInfo['data']
-			result.resultInfo['data'] = resultType.upper()
-			try:
-				result.save()
-			except Exception as e:
-				logger.error(e)
-				abort(400, str(e))
-	
-			try:
-				data = base64.b64decode(data)
-				f = result.fs.new_file('%s_%s' % (resultType, result['_id']))
-				f.write(data)
-				f.close()
-			except TypeError:
-				logger.debug('unable to b64decode %s (result <%s>)' % (resultType, doc['_id']))
-
 	try:
+		binary = _take_result_binary(result)
 		result.save()
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
 
+	# the binary is stored for saved results only
+	if binary is not None:
+		try:
+			_store_result_binary(result, binary)
+		except Exception as e:
+			logger.error(e)
+			db.Result.collection.remove({'_id': result['_id']})
+			abort(400, str(e))
+
+	_result_added(result)
+	results_changed()
+
 	return response({
 		"message": "OK",
 		"resultId": str(result['_id'])
 	})
 
 
+# pcaps compress well, app archives are zip files already
+def _compress_result_binary(resultType):
+	return resultType == Result.TYPE.TCPDUMP and app.config.get('COMPRESS_RESULT_BINARIES', False)
+
+
+# app_archive/tcpdump results are stored in gridfs instead: takes the
+# (decoded) binary out of the result, returns None if there is none
+def _take_result_binary(result):
+	resultType = result.resultInfo.get('type')
+	if not (resultType == Result.TYPE.APP_ARCHIVE or resultType == Result.TYPE.TCPDUMP):
+		return None
+	data = result.resultInfo['data']
+	result.resultInfo['data'] = resultType.upper()
+	result.validate()
+
+	# without data the binary is uploaded via /results/<id>/binary
+	if not data:
+		return None
+	try:
+		data = base64.b64decode(data)
+	except TypeError:
+		logger.debug('unable to b64decode %s (result <%s>)' % (resultType, result.get('_id')))
+		return None
+
+	# the file name contains the result id, so the id is set before saving
+	if not result.get('_id'):
+		result['_id'] = ObjectId()
+	return data
+
+
+def _store_result_binary(result, data):
+	resultType = result.resultInfo['type']
+	blob_write_data(result, '%s_%s' % (resultType, result['_id']), data, _compress_result_binary(resultType))
+
+
+# update data derived from results
+def _result_added(result):
+	# the result is stored already, a failure to update the derived data
+	# must not fail the request (the data is rebuilt via manage.py)
+	try:
+		# keep the per-app criteria summary up to date
+		if result.resultInfo.get('type') == Result.TYPE.CRITERIA and result.run and result.run.app:
+			db.CriteriaSummary.add_result(result.run.app['_id'], result.run['_id'], result['_id'], result.resultInfo['data'])
+		# and the rollups of the analytics routes
+		run = result.run
+		if run and run.app and run.get('executionStrategy') is not None:
+			db.StrategyRollup.add_result(run.app['_id'], run['executionStrategy'], result.resultInfo.get('type'), result.resultInfo.get('data'))
+			db.StrategyHttpRequest.add_result(run.app['_id'], run['executionStrategy'], result.resultInfo.get('type'), result.resultInfo.get('data'))
+	except Exception as e:
+		logger.error('derived data of result <%s> not updated, run manage.py rebuild-criteria and rebuild-rollups: %s' % (result['_id'], e))
+
+
+def _post_results_list(dataList):
+	if not dataList:
+		abort(400, 'No data received')
+
+	# validate all results, each run is resolved once
+	items = []
+	results = []
+	for data in db.Result.rebuild_doc_dicts(db, dataList):
+		item = {}
+		items.append(item)
+		result = db.Result()
+		try:
+			if not data:
+				raise ValueError('No data received')
+			result.update(data)
+			result.validate()
+			item['binary'] = _take_result_binary(result)
+		except Exception as e:
+			item['message'] = str(e)
+			continue
+		item['result'] = result
+		results.append(result)
+
+	# insert the valid results with a single bulk write
+	if results:
+		rawDocs = [validResult.raw_doc() for validResult in results]
+		errors = bulk_insert(db.Result.collection, rawDocs)
+		insertedItems = [entry for entry in items if 'result' in entry]
+		for index, (item, rawDoc) in enumerate(zip(insertedItems, rawDocs)):
+			if index in errors:
+				del item['result']
+				item['message'] = errors[index]
+				continue
+			result = item['result']
+			result['_id'] = rawDoc['_id']
+			# the binaries are stored for inserted results only
+			if item['binary'] is not None:
+				try:
+					_store_result_binary(result, item['binary'])
+				except Exception as e:
+					logger.error(e)
+					db.Result.collection.remove({'_id': result['_id']})
+					del item['result']
+					item['message'] = str(e)
+					continue
+			_result_added(result)
+		if len(errors) < len(rawDocs):
+			results_changed()
+
+	resultList = []
+	for item in items:
+		if 'result' in item:
+			resultList.append({"message": "OK", "resultId": str(item['result']['_id'])})
+		else:
+			resultList.append({"message": item['message']})
+	return response({
+		"message": "OK",
+		"results": resultList
+	})
+
+
+#
+#	Results cache
+#
+# The analytics responses below only change if results, runs or apps are
+# posted. Each of these writes increases the 'results' counter, which is
+# shared by all processes via mongo. Responses are cached per route and
+# query parameters together with the counter value they were built for.
+# The etag is derived from the same key, so unchanged data is answered
+# with 304 without building (or even caching) the response.
+
+_resultsCache = collections.OrderedDict()
+_resultsCacheLock = threading.Lock()
+
+def results_changed():
+	increase_counter('results')
+
+def _results_cache_get(key, generation):
+	with _resultsCacheLock:
+		cached = _resultsCache.pop(key, None)
+		if not cached:
+			return None
+		# keep the most recently used entries last
+		_resultsCache[key] = cached
+	if cached[0] != generation:
+		return None
+	return cached[1]
+
+def _results_cache_set(key, generation, rv):
+	with _resultsCacheLock:
+		_resultsCache.pop(key, None)
+		_resultsCache[key] = (generation, rv)
+		while len(_resultsCache) > app.config.get('RESULTS_CACHE_SIZE', 32):
+			_resultsCache.popitem(last=False)
+
+def cached_results(store=True):
+	""" caches the (json) response of a results route until the next write
+		store=False only answers conditional requests (e.g. for streamed responses)
+	"""
+	def decorator(f):
+		@functools.wraps(f)
+		def wrapper(*args, **kwargs):
+			generation = db.Counter.get_value('results')
+			key = (request.path, tuple(sorted(request.args.iteritems(multi=True))))
+			etag = hashlib.sha1(repr((key, generation))).hexdigest()
+
+			# the client may hold the compressed representation
+			encoding = _accepted_encoding()
+			for candidate in (etag, encoding and '%s-%s' % (etag, encoding)):
+				if candidate and request.if_none_match.contains(candidate):
+					return ('', 304, {'ETag': quote_etag(candidate), 'Cache-Control': 'no-cache'})
+
+			rv = _results_cache_get(key, generation) if store else None
+			if rv is None:
+				rv = f(*args, **kwargs)
+				if store and isinstance(rv, tuple) and rv[1] == 200:
+					_results_cache_set(key, generation, rv)
+
+			rv = current_app.make_response(rv)
+			rv.set_etag(etag)
+			rv.cache_control.no_cache = True
+			return rv
+		return wrapper
+	return decorator
+
+
 ## some special results methods
-@app.route('/results/criteria', methods=["GET"])
-def get_results_criteria():
+
+def _get_clean_docs_by_id(docClass, ids):
+	''' fetches the raw documents with the given ids in a single query
+		returns a dict id -> cleaned doc
+	'''
+	rawDocs = list(docClass.collection.find({'_id': {'$in': list(set(ids))}}))
+	cleanDocs = docClass.clean_raw_docs(db, rawDocs)
+	return dict((rawDoc['_id'], cleanDoc) for rawDoc, cleanDoc in zip(rawDocs, cleanDocs))
+
+
+def _get_criteria_results():
 	query = {
 		'resultInfo.type': Result.TYPE.CRITERIA
 	}
-	cursor = db.Result.find(query)
-	if not cursor or cursor.count() == 0:
+	resultDocs = [doc for doc in db.Result.collection.find(query) if doc.get('run')]
+	if not resultDocs:
 		abort(404, 'No results found for given criteria')
+	return resultDocs
+
+
+@app.route('/results/criteria', methods=["GET"])
+@cached_results()
+def get_results_criteria():
+	resultDocs = _get_criteria_results()
+
+	# resolve all runs and apps with one query each
+	rawRuns = list(db.Run.collection.find({'_id': {'$in': list(set(resultDoc['run'].id for resultDoc in resultDocs))}}))
+	runs = dict(zip([run['_id'] for run in rawRuns], db.Run.clean_raw_docs(db, rawRuns)))
+	runApps = dict((run['_id'], run['app'].id) for run in rawRuns if run.get('app'))
+	apps = _get_clean_docs_by_id(db.App, runApps.values())
 
 	#build criteria result dict
 	results = []
 
-	for resultDoc in cursor:
+	for resultDoc in resultDocs:
+		run = runs.get(resultDoc['run'].id)
+		if not run:
+			continue
 		result = {}
 
 		# add result id
 		result['result'] = str(resultDoc['_id'])
-		
+
 		# add full run doc
-		result['run'] = db.Run.fetch_one({'_id':resultDoc.run['_id']}).clean_doc()
+		result['run'] = run
 
 		# add criteria data
-		result['criteria'] = resultDoc.resultInfo.data
+		result['criteria'] = resultDoc['resultInfo'].get('data')
 		# add app info
-		## necessary to get the concrete type and not just an App document
-		appId = resultDoc.run.app['_id']
-		result['app'] = _get_apps_id_doc(appId).clean_doc()
+		## the app class is chosen by the type field (AppStoreApp/CydiaApp)
+		result['app'] = apps.get(runApps.get(resultDoc['run'].id))
 
 		results.append(result)
 
 	return response(results)
 
 @app.route('/results/criteria/grouped', methods=["GET"])
+@cached_results()
 def get_results_criteria_grouped():
-	query = {
-		'resultInfo.type': Result.TYPE.CRITERIA
-	}
-	cursor = db.Result.find(query)
-	if not cursor or cursor.count() == 0:
+	# served from the per-app summaries maintained by post_results
+	summaries = list(db.CriteriaSummary.collection.find())
+	if not summaries:
 		abort(404, 'No results found for given criteria')
 
+	# resolve all apps with one query
+	apps = _get_clean_docs_by_id(db.App, [summary['app'] for summary in summaries])
+
 	#build criteria result dict
 	results = {}
-
-	for resultDoc in cursor:
-
-		appId = resultDoc.run.app['_id']
-		appIdStr = str(appId)
-		if appIdStr in results: #merge result
-			result = results[appIdStr]
-			# add result/run id
-			result['results'].append(str(resultDoc['_id']))
-			result['runs'].append(str(resultDoc.run['_id']))
-			# combine criteria data
-			criteria = result['criteria']
-			dataDict = resultDoc.resultInfo.data
-			for key in dataDict:
-				value = dataDict[key]
-				if key in criteria:
-					value |= criteria[key]
-				criteria[key] = value
-
-		else: #add new app result
-			result = {}
-			# add result/run id
-			result['results'] = [str(resultDoc['_id'])]
-			result['runs'] = [str(resultDoc.run['_id'])]
-			# add criteria data
-			result['criteria'] = resultDoc.resultInfo.data
-			# add app info
-			## necessary to get the concrete type and not just an App document
-			result['app'] = _get_apps_id_doc(appId).clean_doc()
-
-			results[appIdStr] = result
+	for summary in summaries:
+		results[str(summary['app'])] = {
+			'results': [str(resultId) for resultId in summary.get('results', [])],
+			'runs': [str(runId) for runId in summary.get('runs', [])],
+			'criteria': summary.get('criteria', {}),
+			'app': apps.get(summary['app'])
+		}
 
 	return response(results)
 
+## analytics helpers
+# Coverage, tracking libs and http requests are served from the rollups
+# maintained by post_results (`manage.py rebuild-rollups` recomputes them).
+# The other analytics routes join apps, runs and results. Instead of one
+# query per app and per run, each collection is read once (raw documents,
+# projected to the needed fields, no autoref dereferencing) and joined here.
+
+def _get_analytics_apps(query={}):
+	return db.App.collection.find(query, {'bundleId':1, 'primaryGenreName':1})
+
+
+# the rollups (see StrategyRollup) containing the given aggregate field
+def _get_rollups(field):
+	return db.StrategyRollup.collection.find({field: {'$exists': True}}, {'app':1, 'executionStrategy':1, field:1})
+
+
+def _get_strategy_runs(appIds=None):
+	''' returns a dict runId -> (appId, executionStrategy)
+		for all runs with an execution strategy
+	'''
+	query = {'executionStrategy': {'$ne': None}}
+	if appIds is not None:
+		query['app.$id'] = {'$in': appIds}
+	runs = {}
+	for run in db.Run.collection.find(query, {'app':1, 'executionStrategy':1}):
+		if run.get('app'):
+			runs[run['_id']] = (run['app'].id, run['executionStrategy'])
+	return runs
+
+
+def _iter_strategy_results(resultType, runs, restrictToRuns=False):
+	''' yields (appId, executionStrategy, data) for each result of the
+		given type belonging to one of the given runs
+	'''
+	query = {'resultInfo.type': resultType}
+	if restrictToRuns:
+		query['run.$id'] = {'$in': runs.keys()}
+	for result in db.Result.collection.find(query, {'run':1, 'resultInfo.data':1}):
+		runRef = result.get('run')
+		if not runRef or runRef.id not in runs:
+			continue
+		appId, executionStrategy = runs[runRef.id]
+		yield appId, executionStrategy, result['resultInfo'].get('data')
+
+
 @app.route('/results/coverage', methods=["GET"])
+@cached_results()
 def get_results_coverage():
 	#build coverage result dict
 	results = []
-	
-	appCursor = db.App.find()
-	for app in appCursor:
-		
-		coverageDataDict = {}
-
-		runCursor = db.Run.find({'app.$id':app['_id']})
-		for run in runCursor:
-			
-			executionStrategy = run['executionStrategy']
-			if executionStrategy != None:
-				resultCursor = db.Result.find({'run.$id':run['_id'], 'resultInfo.type': Result.TYPE.COVERAGE})
-				for result in resultCursor:
-					ratioString = result['resultInfo']['data']
-					ratioArray = ratioString.split("/") 
-					if len(ratioArray) == 2:
-						ratio = float(ratioArray[0])/float(ratioArray[1])
-						if executionStrategy not in coverageDataDict or ratio > coverageDataDict[executionStrategy]:
-							coverageDataDict[executionStrategy] = ratio
+
+	# appId -> executionStrategy -> max ratio
+	coverageData = {}
+	for rollup in _get_rollups('coverage'):
+		coverageData.setdefault(rollup['app'], {})[rollup['executionStrategy']] = rollup['coverage']
+
+	for app in _get_analytics_apps():
+		coverageDataDict = coverageData.get(app['_id'], {})
 
 		# add coverage data
 		for executionStrategy,ratio in coverageDataDict.items():
@@ -587,41 +1619,26 @@ def get_results_coverage():
 
 
 @app.route('/results/trackinglibs', methods=["GET"])
+@cached_results()
 def get_results_trackinglibs():
 	#build result dict
 	results = []
 
-	appCursor = db.App.find()
-	for app in appCursor:
+	# appId -> executionStrategy -> lib list
+	libData = {}
+	for rollup in _get_rollups('trackingLibs'):
+		libData.setdefault(rollup['app'], {})[rollup['executionStrategy']] = rollup['trackingLibs']
+
+	for app in _get_analytics_apps():
 
-		appDataDict = { 
+		appDataDict = {
 		# add empty entries for all apps to allow ratio computation afterwards
 			"OpenCloseExecution":[],
 			"RandomExecution":[],
 			"SmartExecution3":[],
 			"SmartExecution5":[],
 		}
-
-		runCursor = db.Run.find({'app.$id':app['_id']})
-		for run in runCursor:
-
-			executionStrategy = run['executionStrategy']
-			if executionStrategy != None:
-				resultCursor = db.Result.find({'run.$id':run['_id'], 'resultInfo.type': Result.TYPE.TRACKING_LIBS})
-				
-				dataArray = None
-				if executionStrategy in appDataDict:
-					dataArray = appDataDict[executionStrategy]
-				for result in resultCursor:
-					libArray = result['resultInfo']['data']
-					if not dataArray:
-						dataArray = libArray
-					else:
-						for lib in libArray:
-							if lib not in dataArray:
-								dataArray.append(lib)
-				if dataArray:
-					appDataDict[executionStrategy] = dataArray
+		appDataDict.update(libData.get(app['_id'], {}))
 
 		# add data
 		for executionStrategy,dataArray in appDataDict.items():
@@ -636,95 +1653,85 @@ def get_results_trackinglibs():
 	return response(results)
 
 @app.route('/results/httprequests', methods=["GET"])
+@cached_results(store=False)
 def get_results_httprequests():
-	#build result dict
-	results = []
-
-	appCursor = db.App.find()
-	for app in appCursor:	
-		appDataDict = {}
-	
-		runCursor = db.Run.find({'app.$id':app['_id']})
-		for run in runCursor:
-			
-			executionStrategy = run['executionStrategy']
-			if executionStrategy != None:
-				resultCursor = db.Result.find({'run.$id':run['_id'], 'resultInfo.type': Result.TYPE.HTTP_REQUESTS})
-				
-				
-				####
-				dataArray = None
-				if executionStrategy in appDataDict:
-					dataArray = appDataDict[executionStrategy]
-					
-				for result in resultCursor:
-					requestArray = result['resultInfo']['data']
-					if not dataArray:
-						dataArray = requestArray
-					else:
-						for request in requestArray:
-							if request not in dataArray:
-								dataArray.append(request)
-				if dataArray:
-					appDataDict[executionStrategy] = dataArray
-					
-					
-				#####
-	
-		# add data
-		for executionStrategy,dataArray in appDataDict.items():
-			result = {
+	# the request corpus is too large to be built in memory at once,
+	# so it is streamed request by request (see StrategyHttpRequest)
+	# grouped into a record per app and execution strategy
+	apps = dict((app['_id'], app) for app in _get_analytics_apps())
+	ndjson = (request.values.get('format') == 'ndjson')
+	requests = db.StrategyHttpRequest.collection.find({}, {'app':1, 'executionStrategy':1, 'request':1})
+	requests = requests.sort([('app', 1), ('executionStrategy', 1), ('_id', 1)])
+
+	def generate():
+		if not ndjson:
+			yield '['
+		first = True
+		for (appId, executionStrategy), docs in itertools.groupby(requests, lambda doc: (doc['app'], doc['executionStrategy'])):
+			app = apps.get(appId)
+			if not app:
+				continue
+			if not first and not ndjson:
+				yield ','
+			first = False
+			# the record without the requests, left open for the request list
+			yield jd({
 				"bundleId": app['bundleId'],
 				"genre": app['primaryGenreName'],
-				"executionStrategy": executionStrategy,
-				"http_requests": dataArray
-			}
-			results.append(result)
-
-	return response(results)
+				"executionStrategy": executionStrategy
+			})[:-1] + ',"http_requests":['
+			for i, doc in enumerate(docs):
+				if i:
+					yield ','
+				yield jd(doc['request'])
+			yield ']}\n' if ndjson else ']}'
+		if not ndjson:
+			yield ']'
+
+	mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+	return current_app.response_class(stream_with_context(_buffered(generate())), mimetype=mimetype)
 
 @app.route('/results/stacktraces', methods=["GET"])
+@cached_results()
 def get_results_stacktraces():
+	# optional filter and per-app pagination:
+	#	bundleId - only apps with the given bundleId
+	#	limit - max number of apps per page
+	#	after - app id of the last app of the previous page
+	# the app id to continue with is returned via the X-Next-After header
+	appQuery = {}
+	if 'bundleId' in request.values:
+		appQuery['bundleId'] = request.values['bundleId']
+	if 'after' in request.values:
+		appQuery['_id'] = {'$gt': get_objectid_param('after')}
+	limit = get_int_param('limit')
+
+	appCursor = _get_analytics_apps(appQuery).sort('_id', 1)
+	if limit:
+		appCursor = appCursor.limit(limit)
+	apps = list(appCursor)
+
+	# restrict the runs/results to the current page
+	restricted = bool(appQuery) or bool(limit)
+	appIds = None
+	if restricted:
+		appIds = [app['_id'] for app in apps]
+	runs = _get_strategy_runs(appIds)
+
+	# appId -> executionStrategy -> trace dict
+	traceData = {}
+	for appId, executionStrategy, traceDict in _iter_strategy_results(Result.TYPE.STACKTRACE, runs, restrictToRuns=restricted):
+		if not traceDict:
+			continue
+		dataDict = traceData.setdefault(appId, {}).setdefault(executionStrategy, {})
+		for key,traceList in traceDict.items():
+			dataDict.setdefault(key, []).extend(traceList)
+
 	#build result dict
 	results = []
-
-	appCursor = db.App.find()
-	for app in appCursor:
-	
-		appDataDict = {}
-
-		runCursor = db.Run.find({'app.$id':app['_id']})
-		for run in runCursor:
-
-			executionStrategy = run['executionStrategy']
-			if executionStrategy != None:
-				
-				resultCursor = db.Result.find({'run.$id':run['_id'], 'resultInfo.type': Result.TYPE.STACKTRACE})
-
-				####
-				dataDict = None
-				if executionStrategy in appDataDict:
-					dataDict = appDataDict[executionStrategy]
-
-				for result in resultCursor:
-					traceDict = result['resultInfo']['data']
-					if not dataDict:
-						dataDict = traceDict
-					else:
-						for key,traceList in traceDict.items():
-							if key in dataDict:
-								for trace in traceList:
-									dataDict[key].append(trace)
-							else:
-								dataDict[key] = traceList
-				if dataDict:
-					appDataDict[executionStrategy] = dataDict
-
-
-				#####
-
+	for app in apps:
 		# add data
-		for executionStrategy,dataArray in appDataDict.items():
+		for executionStrategy,dataDict in traceData.get(app['_id'], {}).items():
 			result = {
 				"bundleId": app['bundleId'],
 				"genre": app['primaryGenreName'],
@@ -733,8 +1740,11 @@ def get_results_stacktraces():
 			}
 			results.append(result)
 
-	return response(results)
-	
+	headers = {}
+	if limit and len(apps) == limit:
+		headers['X-Next-After'] = str(apps[-1]['_id'])
+	return response(results, headers=headers)
+
 #
 #	Run
 #
@@ -746,16 +1756,12 @@ def get_runs():
 	if 'executionStrategy' in request.values:
 		query['executionStrategy'] = request.values['executionStrategy']
 
-	cursor = db.Run.find(query)
-	if not cursor or cursor.count() == 0:
-		abort(404, 'No results found for given criteria')
-	return response_doc_list(cursor)
+	return response_doc_query(db.Run, query)
 
 
 @app.route('/runs/<ObjectId:objid>', methods=["GET"])
 def get_run_id(objid):
-	doc = db.Run.get_or_404(objid)
-	return response_doc(doc)
+	return response_raw_doc(db.Run, {'_id': objid})
 
 
 @app.route('/runs', methods=["POST"])
@@ -764,39 +1770,58 @@ def post_run():
 	data = run.rebuild_doc_dict(db, request.json)
 	if not data:
 		abort(400, 'No data received')
+	# the derived data of the results depends on the app and the strategy
+	# of their run, an updated run may move them to another app/strategy
+	oldRun = None
+	if data.get('_id'):
+		oldRun = db.Run.collection.find_one({'_id': data['_id']}, {'app':1, 'executionStrategy':1})
 	run.update(data)
 	try:
 		run.save()
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	if oldRun:
+		oldAppId = oldRun['app'].id if oldRun.get('app') else None
+		newAppId = run['app']['_id'] if run.get('app') else None
+		if oldAppId != newAppId or oldRun.get('executionStrategy') != run.get('executionStrategy'):
+			_rebuild_app_aggregates([appId for appId in (oldAppId, newAppId) if appId])
+	results_changed()
 	return response({
 		"message": "OK",
 		"runId": str(run['_id'])
 	})
 
 
+def _rebuild_app_aggregates(appIds):
+	# recompute the derived data of the results of the given apps
+	# a failure must not fail the request (see _result_added)
+	if not appIds:
+		return
+	try:
+		db.CriteriaSummary.rebuild(db, appIds)
+		db.StrategyRollup.rebuild(db, appIds)
+		db.StrategyHttpRequest.rebuild(db, appIds)
+	except Exception as e:
+		logger.error('derived data of apps %s not rebuilt, run manage.py rebuild-criteria and rebuild-rollups: %s' % (appIds, e))
+
+
 #
 #	Account
 #
 @app.route('/accounts', methods=["GET"])
 def get_accounts():
-	cursor = db.Account.find()
-	if not cursor or cursor.count() == 0:
-		abort(404, 'No results found for given criteria')
-	return response_doc_list(cursor, 'uniqueIdentifier')
+	return response_doc_query(db.Account, {}, 'uniqueIdentifier')
 
 
 @app.route('/accounts/<int:uniqueIdentifier>', methods=["GET"])
 def get_account_uid(uniqueIdentifier):
-	doc = db.Account.find_one_or_404({'uniqueIdentifier':uniqueIdentifier})
-	return response_doc(doc)
+	return response_raw_doc(db.Account, {'uniqueIdentifier':uniqueIdentifier})
 
 
 @app.route('/accounts/appleid/<appleId>', methods=["GET"])
 def get_account_appleid(appleId):
-	doc = db.Account.find_one_or_404({'appleId':appleId})
-	return response_doc(doc)
+	return response_raw_doc(db.Account, {'appleId':appleId})
 
 
 @app.route('/accounts', methods=["POST"])
@@ -815,6 +1840,8 @@ def post_account():
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	# devices embed their accounts
+	lookupCache.invalidate(db.Account, db.Device)
 	return response({
 		"message": "OK",
 		"accountId": str(acc['uniqueIdentifier'])
@@ -829,16 +1856,12 @@ def get_devices():
 	if 'accountId' in request.values :
 		query['account.$id'] = request.values['accountId']
 
-	cursor = db.Device.find(query)
-	if not cursor or cursor.count() == 0:
-		abort(404, 'No results found for given criteria')
-	return response_doc_list(cursor, 'udid')
+	return response_doc_query(db.Device, query, 'udid')
 
 
 @app.route('/devices/<udid>', methods=["GET"])
 def get_device_udid(udid):
-	doc = db.Device.find_one_or_404({'udid':udid})
-	return response_doc(doc)
+	return response_raw_doc(db.Device, {'udid':udid})
 
 
 @app.route('/devices', methods=["POST"])
@@ -857,6 +1880,7 @@ def post_device():
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	lookupCache.invalidate(db.Device)
 	return response({
 		"message": "OK",
 		"deviceId": str(dev['udid'])
@@ -874,16 +1898,12 @@ def get_workers():
 	if 'name' in request.values :
 		query['name'] = request.values['name']
 
-	cursor = db.Worker.find(query)
-	if not cursor or cursor.count() == 0:
-		abort(404, 'No results found for given criteria')
-	return response_doc_list(cursor)
+	return response_doc_query(db.Worker, query)
 
 
 @app.route('/workers/<ObjectId:objid>', methods=["GET"])
 def get_worker_id(objid):
-	doc = db.Worker.get_or_404(objid)
-	return response_doc(doc)
+	return response_raw_doc(db.Worker, {'_id': objid})
 
 
 @app.route('/workers', methods=["POST"])
@@ -898,12 +1918,25 @@ def post_worker():
 	except Exception as e:
 		logger.error(e)
 		abort(400, str(e))
+	lookupCache.invalidate(db.Worker)
 	return response({
 		"message": "OK",
 		"workerId": str(worker['_id'])
 	})
 
 
+#
+#	Stats
+#
+@app.route('/stats', methods=["GET"])
+def get_stats():
+	# the caches are kept per process
+	return response({
+		'pid': os.getpid(),
+		'lookupCache': lookupCache.stats()
+	})
+
+
 #main: start if directly called
 if __name__ == '__main__':
 	app.run(host='0.0.0.0',port=8080,threaded = True)
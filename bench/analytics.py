@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+# database round trips and latency of the analytics routes against a
+# seeded database: apps with a run per execution strategy, each run with
+# a coverage, tracking_libs, http_requests, stacktrace and criteria result
+#	round trips - queries and getmores of an uncached GET (profiler)
+#	uncached - best time of a GET after results_changed
+#	cached - best time of a repeated GET (answered by cached_results)
+#	usage: bench/analytics.py [--apps N] [--requests N]
+
+import common
+from backend import app, db, results_changed
+from documents import Result
+
+import argparse
+import time
+
+STRATEGIES = ['OpenCloseExecution', 'RandomExecution', 'SmartExecution3', 'SmartExecution5']
+ROUTES = [
+	'/results/coverage',
+	'/results/trackinglibs',
+	'/results/httprequests',
+	'/results/stacktraces',
+	'/results/criteria',
+]
+
+
+def seed(apps, requests):
+	for i in range(apps):
+		appId = db.App.collection.insert({
+			'type': 'AppStoreApp',
+			'name': 'app%d' % i,
+			'bundleId': 'com.example.app%d' % i,
+			'version': '1.0',
+			'primaryGenreName': 'Games' if i % 2 else 'Utilities',
+			'date_added': time.time()
+		})
+		for strategy in STRATEGIES:
+			runId = db.Run.collection.insert({
+				'app': common.ref('apps', appId),
+				'state': 'finished',
+				'executionStrategy': strategy,
+				'date_added': time.time()
+			})
+			runRef = common.ref('runs', runId)
+			resultInfos = [
+				{'type': Result.TYPE.COVERAGE, 'data': '%d/100' % (i % 100)},
+				{'type': Result.TYPE.TRACKING_LIBS, 'data': ['lib%d' % (j % 13) for j in range(i, i + 5)]},
+				{'type': Result.TYPE.HTTP_REQUESTS, 'data': [common.sample_http_request(i * requests + j) for j in range(requests)]},
+				{'type': Result.TYPE.STACKTRACE, 'data': {'trace%d' % (i % 3): ['frame %d' % j for j in range(10)]}},
+				{'type': Result.TYPE.CRITERIA, 'data': {'criterion%d' % j: bool((i + j) % 2) for j in range(5)}},
+			]
+			db.Result.collection.insert([{
+				'run': runRef,
+				'resultInfo': resultInfo,
+				'date_added': time.time()
+			} for resultInfo in resultInfos])
+
+	# the derived data is built like by manage.py
+	db.CriteriaSummary.rebuild(db)
+	db.StrategyRollup.rebuild(db)
+	db.StrategyHttpRequest.rebuild(db)
+
+
+def get(client, path):
+	rv = client.get(path)
+	assert rv.status_code == 200, '%s: %d' % (path, rv.status_code)
+	# the streamed responses query while the body is read
+	rv.get_data()
+
+
+# number of queries (including getmores) of an uncached GET of path
+def count_round_trips(database, client, path):
+	results_changed()
+	database.set_profiling_level(0)
+	database.system.profile.drop()
+	database.set_profiling_level(2)
+	try:
+		get(client, path)
+	finally:
+		database.set_profiling_level(0)
+	return database.system.profile.find({
+		'op': {'$in': ['query', 'getmore']},
+		'ns': {'$ne': '%s.system.profile' % database.name}
+	}).count()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='analytics routes benchmark')
+	parser.add_argument('--apps', type=int, default=200, help='number of apps')
+	parser.add_argument('--requests', type=int, default=50, help='http requests per result')
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args()
+
+	database = db.Result.collection.database
+	common.drop_database(db)
+	try:
+		seed(args.apps, args.requests)
+		client = app.test_client()
+
+		rows = []
+		for path in ROUTES:
+			roundTrips = count_round_trips(database, client, path)
+			def uncached():
+				results_changed()
+				get(client, path)
+			uncachedTime = common.best_time(uncached, args.repeat)
+			get(client, path)
+			cachedTime = common.best_time(lambda: get(client, path), args.repeat)
+			rows.append((path, roundTrips,
+				'%.1f ms' % (uncachedTime * 1000),
+				'%.1f ms' % (cachedTime * 1000)))
+		common.print_table(('route', 'round trips', 'uncached', 'cached'), rows)
+	finally:
+		database.set_profiling_level(0)
+		common.drop_database(db)
+
+
+if __name__ == '__main__':
+	# the documents are bound to the database of the app context
+	with app.app_context():
+		main()
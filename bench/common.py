@@ -0,0 +1,100 @@
+# helpers shared by the benchmark scripts
+#	the scripts import the backend, which connects to the mongod
+#	configured in bench/bench.cfg (or the file given by AABACKEND_SETTINGS);
+#	seeded documents are stored in its database AABackendBench and the
+#	scripts run in an app context (like the requests of the backend)
+
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('AABACKEND_SETTINGS', os.path.join(BENCH_DIR, 'bench.cfg'))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from documents import BackendDocument
+
+
+def sample_http_request(i):
+	return {
+		'url': 'https://tracker%d.example.com/collect?id=%d&session=%s' % (i % 7, i, 'x' * 32),
+		'method': 'GET' if i % 3 else 'POST',
+		'headers': {
+			'User-Agent': 'SampleApp/1.0 CFNetwork/711.3.18 Darwin/14.0.0',
+			'Accept': '*/*',
+			'Accept-Language': 'en-us'
+		}
+	}
+
+
+# a reference into the configured database (set on import of the backend)
+def ref(collection, objid):
+	return DBRef(collection=collection, id=objid, database=BackendDocument.__database__)
+
+
+# a raw result document (as read from mongo) with an http_requests list
+def sample_result(i, requests=200, runId=None):
+	return {
+		'_id': ObjectId(),
+		'run': ref('runs', runId or ObjectId()),
+		'resultInfo': {
+			'type': u'http_requests',
+			'data': [sample_http_request(i * requests + j) for j in range(requests)]
+		},
+		'date_added': time.time()
+	}
+
+
+# best wall clock time of repeat calls of fn
+def best_time(fn, repeat=5):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		fn()
+		duration = time.time() - start
+		if best is None or duration < best:
+			best = duration
+	return best
+
+
+# objects reachable from the given ones (through dicts, lists, tuples and
+# sets) which are not in seen, seen is updated
+def _reachable(objs, seen):
+	stack = list(objs)
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		yield obj
+		if isinstance(obj, dict):
+			stack.extend(obj.iterkeys())
+			stack.extend(obj.itervalues())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			stack.extend(obj)
+
+
+# bytes of the objects of copies (e.g. a cleaned document and its encoding)
+# which are not shared with source, measured with sys.getsizeof (unlike
+# tracemalloc this works on the python 2 runtime)
+def copied_bytes(source, copies):
+	seen = set()
+	for obj in _reachable([source], seen):
+		pass
+	return sum(sys.getsizeof(obj) for obj in _reachable(copies, seen))
+
+
+def print_table(header, rows):
+	widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+	for row in [header] + rows:
+		print '  '.join(str(value).ljust(width) for value, width in zip(row, widths))
+
+
+# drops the benchmark database (never the one of the backend)
+def drop_database(db):
+	database = db.Result.collection.database
+	assert database.name.endswith('Bench'), database.name
+	database.command('dropDatabase')
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+# compression ratio and cpu cost of the gzip/deflate encodings used for
+# stored pcaps (COMPRESS_RESULT_BINARIES) and json responses (COMPRESS_JSON)
+#	usage: bench/compression.py [pcap files]
+#	without files a synthetic capture of http traffic is used
+
+import common
+from backend import jd, _compressor
+
+import argparse
+import random
+import struct
+import time
+import zlib
+
+
+# a pcap file with http requests/responses between a device and some hosts
+def sample_pcap(packets=5000):
+	rnd = random.Random(0)
+	data = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+	for i in range(packets):
+		request = common.sample_http_request(rnd.randint(0, 100))
+		payload = '%s %s HTTP/1.1\r\n%s\r\n\r\n' % (request['method'], request['url'], '\r\n'.join('%s: %s' % item for item in request['headers'].items()))
+		# some packets carry (incompressible) encrypted or compressed content
+		if i % 4 == 0:
+			payload = ''.join(chr(rnd.randint(0, 255)) for j in range(1024))
+		frame = '\x00' * 54 + payload
+		data.append(struct.pack('<IIII', 1400000000 + i, 0, len(frame), len(frame)) + frame)
+	return ''.join(data)
+
+
+def measure(name, data, encoding):
+	start = time.clock()
+	compressor = _compressor(encoding)
+	compressed = compressor.compress(data) + compressor.flush()
+	compressTime = time.clock() - start
+
+	start = time.clock()
+	zlib.decompress(compressed, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+	decompressTime = time.clock() - start
+
+	mb = len(data) / (1024.0 * 1024)
+	return (name, encoding, '%.2f MB' % mb, '%.2f MB' % (len(compressed) / (1024.0 * 1024)),
+		'%.1f%%' % (100.0 * len(compressed) / len(data)),
+		'%.1f MB/s' % (mb / max(compressTime, 1e-6)), '%.1f MB/s' % (mb / max(decompressTime, 1e-6)))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='compression benchmark')
+	parser.add_argument('pcaps', nargs='*', help='pcap files (default: synthetic capture)')
+	parser.add_argument('--results', type=int, default=200, help='number of results in the json result set')
+	args = parser.parse_args()
+
+	samples = []
+	if args.pcaps:
+		for path in args.pcaps:
+			with open(path, 'rb') as f:
+				samples.append((path, f.read()))
+	else:
+		samples.append(('synthetic pcap', sample_pcap()))
+	samples.append(('json result set', jd([common.sample_result(i) for i in range(args.results)])))
+
+	rows = []
+	for name, data in samples:
+		for encoding in ('gzip', 'deflate'):
+			rows.append(measure(name, data, encoding))
+	common.print_table(('sample', 'encoding', 'size', 'compressed', 'ratio', 'compress (cpu)', 'decompress (cpu)'), rows)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+# compares the response encoder (backend.jd) with the former
+# json.dumps(default=json_util.default) encoding
+#	usage: bench/encode.py [--docs N] [--requests N]
+
+import common
+from backend import jd
+
+from bson import json_util
+
+import argparse
+import json
+
+
+def main():
+	parser = argparse.ArgumentParser(description='json encoder benchmark')
+	parser.add_argument('--docs', type=int, default=200, help='number of result documents')
+	parser.add_argument('--requests', type=int, default=50, help='http requests per result')
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args()
+
+	docs = [common.sample_result(i, args.requests) for i in range(args.docs)]
+	# both encodings have to be equal
+	assert json.loads(jd(docs)) == json.loads(json.dumps(docs, default=json_util.default))
+
+	rows = []
+	for name, encode in [
+			('json.dumps(default=json_util.default)', lambda: json.dumps(docs, default=json_util.default)),
+			('jd', lambda: jd(docs)),
+			('jd per document', lambda: [jd(doc) for doc in docs])]:
+		duration = common.best_time(encode, args.repeat)
+		rows.append((name, '%.1f ms' % (duration * 1000)))
+	common.print_table(('encoder', 'best time'), rows)
+
+
+if __name__ == '__main__':
+	main()
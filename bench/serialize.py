@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+# memory and time of the document serializations of the result routes:
+#	clean_doc + jd - mongokit documents (GET /results before user-023)
+#	clean_raw_doc + jd - cleaned copies of raw documents (before user-024)
+#	jd_raw_doc - encoding of the raw documents
+# the copies are the bytes of the objects a serialization of a document
+# materializes besides the document (the cleaned document or the clean
+# items it encodes, and the encoding), the largest is alive at once in a
+# streamed response and the total is allocated by a full list (objects
+# freed while encoding are not counted)
+#	usage: bench/serialize.py [--docs N] [--requests N]
+
+import common
+from backend import app, db, jd, jd_raw_doc
+
+import argparse
+import time
+
+
+def main():
+	parser = argparse.ArgumentParser(description='serialization benchmark')
+	parser.add_argument('--docs', type=int, default=100, help='number of result documents')
+	parser.add_argument('--requests', type=int, default=200, help='http requests per result')
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args()
+
+	common.drop_database(db)
+	try:
+		appId = db.App.collection.insert({'type': 'CydiaApp', 'name': 'app', 'bundleId': 'com.example.app', 'version': '1.0', 'date_added': time.time()})
+		runId = db.Run.collection.insert({'app': common.ref('apps', appId), 'state': 'finished', 'executionStrategy': 'RandomExecution', 'date_added': time.time()})
+		db.Result.collection.insert([common.sample_result(i, args.requests, runId) for i in range(args.docs)])
+
+		rawDocs = list(db.Result.collection.find())
+		docs = list(db.Result.find())
+		refValues = db.Result.resolve_ref_values(db, rawDocs)
+
+		# the encoded documents are dropped right away like in a streamed response
+		def encode_docs():
+			for doc in docs:
+				jd(doc.clean_doc())
+		def encode_clean_raw_docs():
+			for rawDoc in rawDocs:
+				jd(db.Result.clean_raw_doc(rawDoc, refValues))
+		def encode_raw_docs():
+			for rawDoc in rawDocs:
+				jd_raw_doc(db.Result, rawDoc, refValues)
+
+		# the objects materialized per document besides the document
+		def doc_copies(doc):
+			cleanDoc = doc.clean_doc()
+			return cleanDoc, jd(cleanDoc)
+		def clean_raw_doc_copies(rawDoc):
+			cleanDoc = db.Result.clean_raw_doc(rawDoc, refValues)
+			return cleanDoc, jd(cleanDoc)
+		def raw_doc_copies(rawDoc):
+			items = list(db.Result.concrete_class(rawDoc).iter_clean_items(rawDoc, refValues))
+			return items, jd_raw_doc(db.Result, rawDoc, refValues)
+
+		encodings = [
+			('clean_doc + jd', encode_docs, docs, doc_copies),
+			('clean_raw_doc + jd', encode_clean_raw_docs, rawDocs, clean_raw_doc_copies),
+			('jd_raw_doc', encode_raw_docs, rawDocs, raw_doc_copies),
+		]
+		rows = []
+		for name, encode, sources, copies in encodings:
+			copiedBytes = [common.copied_bytes(source, copies(source)) for source in sources]
+			rows.append((name,
+				'%.1f ms' % (common.best_time(encode, args.repeat) * 1000),
+				'%.1f KB' % (max(copiedBytes) / 1024.0),
+				'%.2f MB' % (sum(copiedBytes) / (1024.0 * 1024))))
+		common.print_table(('serialization', 'best time', 'max copies per document', 'total copies'), rows)
+	finally:
+		common.drop_database(db)
+
+
+if __name__ == '__main__':
+	# the documents are bound to the database of the app context
+	with app.app_context():
+		main()
@@ -1,6 +1,15 @@
 from flask.ext.mongokit import Document
 from mongokit import ObjectId, IS, OR, Collection
 from bson.errors import InvalidId
+from bson.dbref import DBRef
+from bson import json_util
+from pymongo.errors import DuplicateKeyError
+from copy import deepcopy
+import collections
+import datetime
+import hashlib
+import json
+import threading
 import time
 import logging
 
@@ -22,20 +31,198 @@ class Enum(dict):
 
 logger = logging.getLogger('Backend.'+__name__)
 
-DATABASE="AABackend"
-
 
+# A bounded in-process cache for documents of the small reference
+# collections (accounts, devices, workers) looked up by a unique key.
+# Entries expire after ttl seconds, the routes changing these documents
+# invalidate them. Callers get copies and may modify them.
+class LookupCache(object):
+	def __init__(self, maxSize=256, ttl=60):
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def configure(self, maxSize, ttl):
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self.clear()
+
+	def find_one(self, docClass, key, value):
+		cacheKey = (docClass.__collection__, key, value)
+		now = time.time()
+		with self._lock:
+			entry = self._entries.pop(cacheKey, None)
+			if entry and entry[0] > now:
+				# keep the most recently used entries last
+				self._entries[cacheKey] = entry
+				self.hits += 1
+				return deepcopy(entry[1])
+			self.misses += 1
+
+		# unknown documents are not cached, they may be added any time
+		doc = docClass.find_one({key: value})
+		if doc is None or self.maxSize <= 0:
+			return doc
+		with self._lock:
+			self._entries[cacheKey] = (now + self.ttl, deepcopy(doc))
+			while len(self._entries) > self.maxSize:
+				self._entries.popitem(last=False)
+		return doc
+
+	def invalidate(self, *docClasses):
+		names = set(docClass.__collection__ for docClass in docClasses)
+		with self._lock:
+			for cacheKey in [cacheKey for cacheKey in self._entries if cacheKey[0] in names]:
+				del self._entries[cacheKey]
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		with self._lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'size': len(self._entries),
+				'maxSize': self.maxSize,
+				'ttl': self.ttl
+			}
+
+lookupCache = LookupCache()
+
+
+# Results stored after the returned id may be missing in a rebuild of
+# derived data and are merged again afterwards. The margin covers ids
+# created with the clocks of other hosts.
+REBUILD_MARGIN = 60
+
+def rebuild_marker():
+	return ObjectId.from_datetime(datetime.datetime.utcnow() - datetime.timedelta(seconds=REBUILD_MARGIN))
+
+# the default database, the backend uses the configured one (MONGODB_DATABASE)
+DATABASE = 'AABackend'
+
+
+# Methods using the collection are instance methods called on the registered
+# documents (e.g. db.Counter.increase), the classes mongokit generates on
+# registration are not bound to a collection, only their instances are.
 class BackendDocument(Document):
 	__database__ = DATABASE
 
+	# reference fields: field -> (referenced document class, key of the
+	# referenced document used to represent it in cleaned docs)
+	ref_fields = {}
+
+	# additional indexes for the hot queries, same format as indexes
+	# these are kept apart as mongokit can not validate reference
+	# paths like 'app.$id' against the structure
+	query_indexes = []
+
+	# the declared indexes are needed for correctness (unique keys which
+	# deduplicate concurrent writes), they are created on startup
+	indexes_required = False
+
+	# creates all declared indexes (indexes and query_indexes)
+	@classmethod
+	def ensure_indexes(cls, collection):
+		created = []
+		for index in (cls.indexes or []) + cls.query_indexes:
+			fields = index['fields']
+			if isinstance(fields, (basestring, tuple)):
+				fields = [fields]
+			keys = []
+			for field in fields:
+				if isinstance(field, basestring):
+					field = (field, 1)
+				keys.append(field)
+			created.append(collection.create_index(keys, unique=index.get('unique', False), background=True))
+		return created
+
 	#	returns a copy of self!
 	def clean_doc(self):
 		cp = self.copy()
 		if '_id' in self:
-			cp = self.copy()
 			cp['_id'] = str(self['_id'])
 		return cp
 
+	# the class to use for the given raw document (see App)
+	@classmethod
+	def concrete_class(cls, rawDoc):
+		return cls
+
+	# the (key, value) pairs of clean_raw_doc, without copying rawDoc
+	#	refValues: (refClass, refKey) -> {id: value}
+	@classmethod
+	def iter_clean_items(cls, rawDoc, refValues={}):
+		for key, value in rawDoc.iteritems():
+			if key == '_id':
+				value = str(value)
+			elif value and key in cls.ref_fields:
+				refClass, refKey = cls.ref_fields[key]
+				values = refValues.get((refClass, refKey), {})
+				def clean_ref(ref):
+					if refKey == '_id':
+						return str(ref.id)
+					return values.get(ref.id)
+				if isinstance(value, list):
+					value = [clean_ref(ref) for ref in value]
+				else:
+					value = clean_ref(value)
+			yield key, value
+
+	# clean_doc for raw (unwrapped) documents containing DBRefs
+	@classmethod
+	def clean_raw_doc(cls, rawDoc, refValues={}):
+		return dict(cls.iter_clean_items(rawDoc, refValues))
+
+	# referenced values other than ids of the given raw documents,
+	# resolved with one query per referenced collection
+	#	returns (refClass, refKey) -> {id: value}
+	@classmethod
+	def resolve_ref_values(cls, db, rawDocs):
+		refIds = {}
+		for rawDoc in rawDocs:
+			for field, refInfo in cls.concrete_class(rawDoc).ref_fields.iteritems():
+				if refInfo[1] == '_id' or not rawDoc.get(field):
+					continue
+				refs = rawDoc[field]
+				if not isinstance(refs, list):
+					refs = [refs]
+				refIds.setdefault(refInfo, set()).update(ref.id for ref in refs)
+
+		refValues = {}
+		for (refClass, refKey), ids in refIds.iteritems():
+			values = refValues[(refClass, refKey)] = {}
+			cursor = getattr(db, refClass.__name__).collection.find({'_id': {'$in': list(ids)}}, {refKey: 1})
+			for refDoc in cursor:
+				values[refDoc['_id']] = refDoc.get(refKey)
+		return refValues
+
+	# cleans a list of raw documents
+	@classmethod
+	def clean_raw_docs(cls, db, rawDocs):
+		refValues = cls.resolve_ref_values(db, rawDocs)
+		return [cls.concrete_class(rawDoc).clean_raw_doc(rawDoc, refValues) for rawDoc in rawDocs]
+
+	# returns a raw copy of self with references replaced by DBRefs
+	# as stored by save(), e.g. for bulk inserts
+	def raw_doc(self):
+		rawDoc = dict(self)
+		for field, (refClass, refKey) in self.ref_fields.iteritems():
+			if not rawDoc.get(field):
+				continue
+			def make_ref(doc):
+				return DBRef(collection=refClass.__collection__, id=doc['_id'], database=refClass.__database__)
+			if isinstance(rawDoc[field], list):
+				rawDoc[field] = [make_ref(doc) for doc in rawDoc[field]]
+			else:
+				rawDoc[field] = make_ref(rawDoc[field])
+		return rawDoc
+
 #TODO handle everything here by inspectiong the structure dict!
 	@classmethod
 	def rebuild_doc_dict(cls, db, docDict):
@@ -117,6 +304,9 @@ class Device(BackendDocument):
 		'accounts': [Account]
 	}
 	required_fields = ['udid', 'accounts', 'deviceInfo']
+	ref_fields = {
+		'accounts': (Account, 'uniqueIdentifier')
+	}
 	indexes = [{
 		'fields':['udid'],
 		'unique':True,
@@ -139,7 +329,7 @@ class Device(BackendDocument):
 			accList = []
 			accIdList = docDict['accounts']
 			for accId in accIdList:
-				acc = db.Account.find_one({'uniqueIdentifier':accId})
+				acc = lookupCache.find_one(db.Account, 'uniqueIdentifier', accId)
 				accList.append(acc)
 
 			docDict['accounts'] = accList
@@ -163,6 +353,10 @@ class Job(BackendDocument):
 		'date_added': float
 	}
 	required_fields = ['type', 'state', 'jobInfo']
+	ref_fields = {
+		'worker': (Worker, '_id'),
+		'device': (Device, 'udid')
+	}
 	default_values = {
 		'date_added': time.time,
 		'state': STATE.UNDEFINED
@@ -170,6 +364,15 @@ class Job(BackendDocument):
 	indexes = [{
 		'fields':['type', 'state'],
 	}]
+	query_indexes = [{
+		# job claim: state filter sorted by date_added
+		'fields':[('state', 1), ('date_added', -1)],
+	},{
+		# unfinished jobs of a worker/device
+		'fields':['worker.$id', 'device.$id', 'state'],
+	},{
+		'fields':['device.$id', 'state'],
+	}]
 
 	def clean_doc(self):
 		cp = super(Job, self).clean_doc()
@@ -190,12 +393,12 @@ class Job(BackendDocument):
 			except InvalidId:
 				return docDict
 
-			worker = db.Worker.find_one({'_id':workerId})
+			worker = lookupCache.find_one(db.Worker, '_id', workerId)
 			docDict['worker'] = worker
 
 		if 'device' in docDict:
 			deviceId = docDict['device']
-			device = db.Device.find_one({'udid':deviceId})
+			device = lookupCache.find_one(db.Device, 'udid', deviceId)
 			if device:
 				docDict['device'] = device
 			else:
@@ -204,11 +407,75 @@ class Job(BackendDocument):
 					deviceId = ObjectId(deviceId)
 				except InvalidId:
 					logger.debug('given string %s is not a deviceId' % deviceId)
-				device = db.Device.find_one({'_id':deviceId})
+				device = lookupCache.find_one(db.Device, '_id', deviceId)
 				if device:
 					docDict['device'] = device
 		return docDict
 
+	# rebuild_doc_dict for a list of jobs, resolving all
+	# workers and devices with one query each
+	@classmethod
+	def rebuild_doc_dicts(cls, db, docDicts):
+		docDicts = [super(Job, cls).rebuild_doc_dict(db, docDict) for docDict in docDicts]
+
+		workerIds = set()
+		deviceKeys = set()
+		for docDict in docDicts:
+			if docDict.get('worker'):
+				try:
+					workerIds.add(ObjectId(docDict['worker']))
+				except (InvalidId, TypeError):
+					pass
+			if docDict.get('device'):
+				deviceKeys.add(docDict['device'])
+
+		workers = {}
+		if workerIds:
+			for worker in db.Worker.find({'_id': {'$in': list(workerIds)}}):
+				workers[worker['_id']] = worker
+
+		devices = {}
+		if deviceKeys:
+			deviceIds = []
+			for key in deviceKeys:
+				try:
+					deviceIds.append(ObjectId(key))
+				except (InvalidId, TypeError):
+					pass
+			deviceQuery = {'$or': [
+				{'udid': {'$in': list(deviceKeys)}},
+				{'_id': {'$in': deviceIds}}
+			]}
+			for device in db.Device.find(deviceQuery):
+				devices[device['udid']] = device
+				devices[str(device['_id'])] = device
+
+		for docDict in docDicts:
+			if 'worker' in docDict:
+				try:
+					docDict['worker'] = workers.get(ObjectId(docDict['worker']))
+				except (InvalidId, TypeError):
+					continue
+			if 'device' in docDict:
+				device = devices.get(docDict['device'])
+				if device:
+					docDict['device'] = device
+		return docDicts
+
+	# query matching the jobs able to run on a device with the given accounts
+	# (the query equivalent of can_run_on_device)
+	@classmethod
+	def device_query(cls, accounts):
+		accounts = [acc for acc in accounts if acc]
+		accountIds = [acc['uniqueIdentifier'] for acc in accounts]
+		countries = [acc['storeCountry'] for acc in accounts]
+		return {"$or": [
+			{"type": {"$ne": Job.TYPE.RUN_APP}},
+			{"jobInfo.accountId": {"$in": accountIds}},
+			{"jobInfo.accountId": {"$exists": False}, "jobInfo.storeCountry": {"$in": countries}},
+			{"jobInfo.accountId": {"$exists": False}, "jobInfo.storeCountry": {"$exists": False}}
+		]}
+
 	def can_run_on_device(self, device):
 		if self.type == Job.TYPE.RUN_APP:
 			jobInfo = self.jobInfo
@@ -254,6 +521,31 @@ class App(BackendDocument):
 	# this will fix validation errors for superclass fields
 	use_schemaless = True
 
+	# use the concrete app class given by the type field
+	@classmethod
+	def concrete_class(cls, rawDoc):
+		appClasses = {
+			'AppStoreApp': AppStoreApp,
+			'CydiaApp': CydiaApp
+		}
+		return appClasses.get(rawDoc.get(cls.type_field), cls)
+
+	# finds the apps matching query with a single query on the apps
+	# collection, each one wrapped in its concrete app class
+	# apps without a known type are skipped
+	@classmethod
+	def find_concrete(cls, db, query):
+		for rawDoc in db.App.collection.find(query):
+			docClass = cls.concrete_class(rawDoc)
+			if docClass is not App:
+				yield getattr(db, docClass.__name__)(rawDoc)
+
+	@classmethod
+	def find_one_concrete(cls, db, query):
+		for app in cls.find_concrete(db, query):
+			return app
+		return None
+
 
 class AppStoreApp(App):
 	use_schemaless = True
@@ -264,6 +556,9 @@ class AppStoreApp(App):
 		'price': OR(float, basestring),
 	}
 	required_fields = ['trackId', 'account']
+	ref_fields = {
+		'account': (Account, 'uniqueIdentifier')
+	}
 	indexes = [{
 		'fields':['bundleId', 'version'],
 		'unique':True,
@@ -282,9 +577,7 @@ class AppStoreApp(App):
 		docDict = super(AppStoreApp, cls).rebuild_doc_dict(db, docDict)
 
 		if 'account' in docDict:
-			acc = db.Account.find_one({
-				'uniqueIdentifier': str(docDict['account'])
-			})
+			acc = lookupCache.find_one(db.Account, 'uniqueIdentifier', str(docDict['account']))
 			docDict['account'] = acc
 		return docDict
 
@@ -307,12 +600,19 @@ class Run(BackendDocument):
 		'date_added': float
 	}
 	required_fields = ['app']
+	ref_fields = {
+		'app': (App, '_id')
+	}
 	default_values = {
 		'date_added': time.time
 	}
 	indexes = [{
 		'fields':['state'],
 	}]
+	query_indexes = [{
+		# runs of an app (per execution strategy)
+		'fields':['app.$id', 'executionStrategy'],
+	}]
 
 	def clean_doc(self):
 		cp = super(Run, self).clean_doc()
@@ -331,9 +631,7 @@ class Run(BackendDocument):
 			except InvalidId:
 				return docDict
 
-			app = db.AppStoreApp.find_one({'_id':appId})
-			if not app:
-				app = db.CydiaApp.find_one({'_id':appId})
+			app = App.find_one_concrete(db, {'_id':appId})
 
 			docDict['app'] = app
 		return docDict
@@ -356,12 +654,19 @@ class Result(BackendDocument):
 		'files': ['apparchive']
 	}
 	required_fields = ['run']
+	ref_fields = {
+		'run': (Run, '_id')
+	}
 	default_values = {
 		'date_added': time.time
 	}
 	indexes = [{
 		'fields':['resultInfo.type'],
 	}]
+	query_indexes = [{
+		# results of a run (per result type)
+		'fields':['run.$id', 'resultInfo.type'],
+	}]
 
 	def clean_doc(self):
 		cp = super(Result, self).clean_doc()
@@ -385,4 +690,360 @@ class Result(BackendDocument):
 			docDict['run'] = run
 		return docDict
 
+	# rebuild_doc_dict for a list of results, resolving all runs with one query
+	@classmethod
+	def rebuild_doc_dicts(cls, db, docDicts):
+		docDicts = [super(Result, cls).rebuild_doc_dict(db, docDict) for docDict in docDicts]
+
+		runIds = set()
+		for docDict in docDicts:
+			if docDict.get('run'):
+				try:
+					runIds.add(ObjectId(docDict['run']))
+				except (InvalidId, TypeError):
+					pass
+
+		runs = {}
+		if runIds:
+			for run in db.Run.find({'_id': {'$in': list(runIds)}}):
+				runs[run['_id']] = run
+
+		for docDict in docDicts:
+			if 'run' in docDict:
+				try:
+					docDict['run'] = runs.get(ObjectId(docDict['run']))
+				except (InvalidId, TypeError):
+					pass
+		return docDicts
+
+
 
+# Per-app summary of all CRITERIA results (criteria merged by bitwise or)
+# maintained by post_results, rebuild via `manage.py rebuild-criteria`
+class CriteriaSummary(BackendDocument):
+	use_autorefs = False
+	__collection__ = 'criteria_summaries'
+	structure = {
+		'app': ObjectId,
+		'criteria': dict,
+		'results': [ObjectId],
+		'runs': [ObjectId]
+	}
+	required_fields = ['app']
+	indexes = [{
+		'fields':['app'],
+		'unique':True,
+	}]
+	# a result is merged once per app (see add_result)
+	indexes_required = True
+
+	@staticmethod
+	def merge_criteria(criteria, dataDict):
+		for key in dataDict:
+			value = dataDict[key]
+			if key in criteria:
+				value |= criteria[key]
+			criteria[key] = value
+		return criteria
+
+	# atomically merge a single criteria result into the app summary
+	# merging the same result again has no effect
+	def add_result(self, appId, runId, resultId, dataDict):
+		update = {
+			'$push': {
+				'results': resultId,
+				'runs': runId
+			}
+		}
+		for key, value in (dataDict or {}).iteritems():
+			field = 'criteria.%s' % key
+			if isinstance(value, (int, long)) and not isinstance(value, bool):
+				update.setdefault('$bit', {})[field] = {'or': value}
+			else:
+				update.setdefault('$max', {})[field] = value
+		try:
+			self.collection.update({'app': appId, 'results': {'$ne': resultId}}, update, upsert=True)
+		except DuplicateKeyError:
+			# the summary of the app contains the result already
+			pass
+
+	# yields (appId, runId, resultDoc) for the criteria results matching query
+	# (of the runs of the given apps or all)
+	@staticmethod
+	def _iter_results(db, appIds=None, query={}):
+		runQuery = {}
+		if appIds is not None:
+			runQuery['app.$id'] = {'$in': list(appIds)}
+		runApps = {}
+		for run in db.Run.collection.find(runQuery, {'app':1}):
+			if run.get('app'):
+				runApps[run['_id']] = run['app'].id
+
+		query = dict(query)
+		query['resultInfo.type'] = Result.TYPE.CRITERIA
+		if appIds is not None:
+			query['run.$id'] = {'$in': runApps.keys()}
+		for resultDoc in db.Result.collection.find(query, {'run':1, 'resultInfo.data':1}):
+			if not resultDoc.get('run') or resultDoc['run'].id not in runApps:
+				continue
+			runId = resultDoc['run'].id
+			yield runApps[runId], runId, resultDoc
+
+	# recompute the summaries of the given apps (or all) from the stored
+	# criteria results. Each summary is replaced by a single upsert, the
+	# results stored meanwhile are merged again afterwards.
+	def rebuild(self, db, appIds=None):
+		since = rebuild_marker()
+		summaries = {}
+		for appId, runId, resultDoc in self._iter_results(db, appIds):
+			summary = summaries.setdefault(appId, {'criteria': {}, 'results': [], 'runs': []})
+			summary['results'].append(resultDoc['_id'])
+			summary['runs'].append(runId)
+			self.merge_criteria(summary['criteria'], resultDoc['resultInfo'].get('data') or {})
+
+		for appId, summary in summaries.iteritems():
+			self.collection.update({'app': appId}, {'$set': summary}, upsert=True)
+		# apps without criteria results (anymore)
+		if appIds is None:
+			self.collection.remove({'app': {'$nin': summaries.keys()}})
+		else:
+			self.collection.remove({'app': {'$in': [appId for appId in appIds if appId not in summaries]}})
+
+		for appId, runId, resultDoc in self._iter_results(db, appIds, {'_id': {'$gte': since}}):
+			self.add_result(appId, runId, resultDoc['_id'], resultDoc['resultInfo'].get('data'))
+		return len(summaries)
+
+
+# Aggregates of the analytics results per app and execution strategy.
+# They are merged atomically by post_results (see add_result), merging
+# the same result twice has no effect.
+class StrategyAggregate(BackendDocument):
+	use_autorefs = False
+
+	# the result types merged by add_result(appId, executionStrategy, resultType, data),
+	# which each aggregate defines
+	result_types = []
+	# a result is merged once (see add_result)
+	indexes_required = True
+
+	# yields (appId, executionStrategy, resultType, data) for the results of the
+	# given types matching query (of the runs of the given apps or all)
+	@staticmethod
+	def _iter_results(db, resultTypes, appIds=None, query={}):
+		runQuery = {'executionStrategy': {'$ne': None}}
+		if appIds is not None:
+			runQuery['app.$id'] = {'$in': list(appIds)}
+		runs = {}
+		for run in db.Run.collection.find(runQuery, {'app':1, 'executionStrategy':1}):
+			if run.get('app'):
+				runs[run['_id']] = (run['app'].id, run['executionStrategy'])
+
+		query = dict(query)
+		query['resultInfo.type'] = {'$in': resultTypes}
+		if appIds is not None:
+			query['run.$id'] = {'$in': runs.keys()}
+		for resultDoc in db.Result.collection.find(query, {'run':1, 'resultInfo':1}):
+			if not resultDoc.get('run') or resultDoc['run'].id not in runs:
+				continue
+			appId, executionStrategy = runs[resultDoc['run'].id]
+			yield appId, executionStrategy, resultDoc['resultInfo'].get('type'), resultDoc['resultInfo'].get('data')
+
+	# recompute the aggregates of the given apps (or all) from the stored
+	# results, the results stored meanwhile are merged again afterwards
+	# the results are merged one by one, the request corpus may be large
+	def rebuild(self, db, appIds=None):
+		since = rebuild_marker()
+		if appIds is None:
+			self.collection.remove({})
+		else:
+			self.collection.remove({'app': {'$in': list(appIds)}})
+		for args in self._iter_results(db, self.result_types, appIds):
+			self.add_result(*args)
+		for args in self._iter_results(db, self.result_types, appIds, {'_id': {'$gte': since}}):
+			self.add_result(*args)
+		return self.collection.find().count()
+
+
+# max. coverage ratio and tracking libs per app and execution strategy
+class StrategyRollup(StrategyAggregate):
+	__collection__ = 'strategy_rollups'
+	structure = {
+		'app': ObjectId,
+		'executionStrategy': basestring,
+		'coverage': float,
+		'trackingLibs': list
+	}
+	required_fields = ['app', 'executionStrategy']
+	indexes = [{
+		'fields':['app', 'executionStrategy'],
+		'unique':True,
+	}]
+	result_types = [Result.TYPE.COVERAGE, Result.TYPE.TRACKING_LIBS]
+
+	# returns the ratio of a coverage result like '12/345' or None
+	@staticmethod
+	def coverage_ratio(ratioString):
+		if not isinstance(ratioString, basestring):
+			return None
+		ratioArray = ratioString.split('/')
+		if len(ratioArray) != 2:
+			return None
+		try:
+			return float(ratioArray[0])/float(ratioArray[1])
+		except (ValueError, ZeroDivisionError):
+			return None
+
+	@classmethod
+	def result_update(cls, resultType, data):
+		if resultType == Result.TYPE.COVERAGE:
+			ratio = cls.coverage_ratio(data)
+			if ratio is not None:
+				return {'$max': {'coverage': ratio}}
+		elif resultType == Result.TYPE.TRACKING_LIBS and data:
+			return {'$addToSet': {'trackingLibs': {'$each': list(data)}}}
+		return None
+
+	# atomically merge a single result into the rollup of its app and strategy
+	def add_result(self, appId, executionStrategy, resultType, data):
+		update = self.result_update(resultType, data)
+		if update:
+			self.collection.update({'app': appId, 'executionStrategy': executionStrategy}, update, upsert=True)
+
+
+# The distinct http requests per app and execution strategy, a document per
+# request. The request corpus is too large for a single rollup document.
+class StrategyHttpRequest(StrategyAggregate):
+	__collection__ = 'strategy_http_requests'
+	structure = {
+		'app': ObjectId,
+		'executionStrategy': basestring,
+		'hash': basestring,
+		'request': dict
+	}
+	required_fields = ['app', 'executionStrategy', 'hash']
+	indexes = [{
+		'fields':['app', 'executionStrategy', 'hash'],
+		'unique':True,
+	}]
+	# the requests are listed in the order they were first reported
+	query_indexes = [{
+		'fields':['app', 'executionStrategy', '_id'],
+	}]
+	result_types = [Result.TYPE.HTTP_REQUESTS]
+
+	@staticmethod
+	def request_hash(request):
+		return hashlib.sha1(json.dumps(request, sort_keys=True, default=json_util.default)).hexdigest()
+
+	# inserts the requests of a result, known requests fail on the unique index
+	def add_result(self, appId, executionStrategy, resultType, data):
+		if resultType != Result.TYPE.HTTP_REQUESTS or not data:
+			return
+		docs = collections.OrderedDict()
+		for request in data:
+			requestHash = self.request_hash(request)
+			if requestHash not in docs:
+				docs[requestHash] = {
+					'app': appId,
+					'executionStrategy': executionStrategy,
+					'hash': requestHash,
+					'request': request
+				}
+		try:
+			self.collection.insert(docs.values(), continue_on_error=True)
+		except DuplicateKeyError:
+			pass
+
+
+# Change counters (_id is the counter name), increased on writes to let
+# waiting requests of all processes notice changes
+class Counter(BackendDocument):
+	use_autorefs = False
+	__collection__ = 'counters'
+	structure = {
+		'_id': basestring,
+		'value': int
+	}
+
+	def increase(self, name):
+		self.collection.update({'_id': name}, {'$inc': {'value': 1}}, upsert=True)
+
+	def get_value(self, name):
+		counter = self.collection.find_one({'_id': name})
+		if not counter:
+			return 0
+		return counter['value']
+
+
+# A resumable upload of a (large) file belonging to the target document
+# the received parts are kept as separate gridfs files until finalized
+class Upload(BackendDocument):
+	use_autorefs = False
+	__collection__ = 'uploads'
+	structure = {
+		'target': ObjectId,
+		'filename': basestring,
+		'sha256': basestring,
+		'length': OR(int, long),
+		'offset': OR(int, long),
+		'parts': [{
+			'offset': OR(int, long),
+			'length': OR(int, long),
+			'file': ObjectId
+		}],
+		'date_added': float
+	}
+	required_fields = ['target', 'filename', 'sha256']
+	default_values = {
+		'offset': 0,
+		'date_added': time.time
+	}
+	indexes = [{
+		'fields':['target'],
+	}]
+
+
+# Content addressed gridfs storage: each distinct content (sha256) of a
+# store (the collection owning the gridfs) is kept once, refs holds the
+# names linked to it (the reference count)
+class Blob(BackendDocument):
+	use_autorefs = False
+	__collection__ = 'blobs'
+	structure = {
+		'store': basestring,
+		'sha256': basestring,
+		'file': ObjectId,
+		'length': OR(int, long),
+		'refs': [basestring],
+		'date_added': float
+	}
+	required_fields = ['store', 'sha256', 'file']
+	default_values = {
+		'date_added': time.time
+	}
+	indexes = [{
+		'fields':['store', 'sha256'],
+		'unique':True,
+	},{
+		'fields':['store', 'refs'],
+	}]
+	# a content is stored once per store (see link)
+	indexes_required = True
+
+	# links name to the stored content, returns False if there is no such blob
+	def link(self, store, sha256, name):
+		blob = self.find_and_modify(query={'store': store, 'sha256': sha256}, update={'$addToSet': {'refs': name}}, new=True)
+		return bool(blob and '_id' in blob)
+
+	def find_by_name(self, store, name):
+		return self.collection.find_one({'store': store, 'refs': name})
+
+	# removes the link of name, returns the file id if it was the last reference
+	def unlink(self, store, name):
+		blob = self.find_and_modify(query={'store': store, 'refs': name}, update={'$pull': {'refs': name}}, new=True)
+		if not blob or '_id' not in blob or blob['refs']:
+			return None
+		removed = self.collection.remove({'_id': blob['_id'], 'refs': {'$size': 0}})
+		if not removed or not removed.get('n'):
+			return None
+		return blob['file']
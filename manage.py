@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# maintenance commands for the backend database
+#	usage: manage.py <command>
+
+from backend import app, db, logger, ensure_indexes, expire_uploads, job_claim_query, results_changed
+from documents import Job, Result
+
+from bson.objectid import ObjectId
+
+import argparse
+import sys
+
+
+def rebuild_criteria(args):
+	count = db.CriteriaSummary.rebuild(db)
+	results_changed()
+	logger.info('rebuilt criteria summaries for %d apps' % count)
+
+
+def rebuild_rollups(args):
+	count = db.StrategyRollup.rebuild(db)
+	requestCount = db.StrategyHttpRequest.rebuild(db)
+	results_changed()
+	logger.info('rebuilt %d analytics rollups and %d http requests' % (count, requestCount))
+
+
+def expire_uploads_command(args):
+	maxAge = args.max_age
+	if maxAge is None:
+		maxAge = app.config.get('UPLOAD_MAX_AGE', 24 * 60 * 60)
+	count = expire_uploads(maxAge)
+	logger.info('removed %d expired uploads' % count)
+
+
+def ensure_indexes_command(args):
+	ensure_indexes()
+	logger.info('indexes ensured')
+
+
+# the canonical queries of the hot routes: (name, document, query, sort)
+def _canonical_queries():
+	someId = ObjectId()
+	openStates = {'$nin': [Job.STATE.FINISHED, Job.STATE.FAILED]}
+	return [
+		('runs of apps (analytics)', db.Run, {'app.$id': {'$in': [someId]}, 'executionStrategy': {'$ne': None}}, None),
+		('GET /runs?appId', db.Run, {'app.$id': someId, 'executionStrategy': 'DefaultExecution'}, None),
+		('GET /results?runId', db.Result, {'run.$id': someId, 'resultInfo.type': Result.TYPE.COVERAGE}, None),
+		('results of runs (analytics)', db.Result, {'run.$id': {'$in': [someId]}, 'resultInfo.type': Result.TYPE.HTTP_REQUESTS}, None),
+		('results by type (criteria)', db.Result, {'resultInfo.type': Result.TYPE.CRITERIA}, None),
+		('GET /jobs', db.Job, {'state': {'$in': Job.STATE.values()}}, None),
+		('unfinished job of worker/device', db.Job, {'worker.$id': someId, 'device.$id': someId, 'state': openStates}, None),
+		('job claim', db.Job, job_claim_query(someId, someId, []), [('date_added', -1)]),
+	]
+
+
+def _is_collection_scan(plan):
+	if isinstance(plan, dict):
+		# MongoDB >= 3.0 uses stages, older versions cursor names
+		if plan.get('stage') == 'COLLSCAN' or str(plan.get('cursor', '')).startswith('BasicCursor'):
+			return True
+		return any(_is_collection_scan(value) for key, value in plan.items() if key not in ('allPlans', 'rejectedPlans'))
+	if isinstance(plan, list):
+		return any(_is_collection_scan(value) for value in plan)
+	return False
+
+
+def check_indexes(args):
+	failed = []
+	for name, doc, query, sort in _canonical_queries():
+		cursor = doc.collection.find(query)
+		if sort:
+			cursor = cursor.sort(sort)
+		plan = cursor.explain()
+		plan = plan.get('queryPlanner', {}).get('winningPlan', plan)
+		if _is_collection_scan(plan):
+			failed.append(name)
+			logger.error('collection scan for query: %s' % name)
+		else:
+			logger.info('index used for query: %s' % name)
+	if failed:
+		sys.exit(1)
+
+
+COMMANDS = {
+	'rebuild-criteria': rebuild_criteria,
+	'rebuild-rollups': rebuild_rollups,
+	'ensure-indexes': ensure_indexes_command,
+	'expire-uploads': expire_uploads_command,
+	'check-indexes': check_indexes,
+}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='DiOS backend maintenance')
+	parser.add_argument('command', choices=sorted(COMMANDS.keys()))
+	parser.add_argument('--max-age', type=int, help='expire-uploads: max. age of an upload in seconds')
+	args = parser.parse_args()
+	with app.app_context():
+		COMMANDS[args.command](args)
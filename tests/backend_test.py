@@ -0,0 +1,82 @@
+# base of the backend tests
+#	needs a running mongod, the tests are skipped if it can not be reached
+#	the documents are stored in the database configured in tests/test.cfg,
+#	which is dropped by each test
+
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('AABACKEND_SETTINGS', os.path.join(TESTS_DIR, 'test.cfg'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+
+from pymongo.errors import ConnectionFailure
+# the backend connects on import
+try:
+	import backend
+	connectionError = None
+except ConnectionFailure as e:
+	backend = None
+	connectionError = e
+
+from documents import BackendDocument, lookupCache
+from bson.dbref import DBRef
+from flask import json
+
+
+def ref(collection, objid):
+	return DBRef(collection=collection, id=objid, database=BackendDocument.__database__)
+
+
+@unittest.skipIf(backend is None, 'no database: %s' % connectionError)
+class BackendTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.context = backend.app.app_context()
+		self.context.push()
+		self.addCleanup(self.context.pop)
+		self.db = backend.db
+		self.database = self.db.Job.collection.database
+		self.assertTrue(self.database.name.endswith('Test'), 'the tests drop their database %s' % self.database.name)
+		self.database.command('dropDatabase')
+		# like on startup
+		backend.ensure_indexes(requiredOnly=True)
+		# the per-process caches hold documents of the previous test
+		lookupCache.clear()
+		backend._resultsCache.clear()
+		self.client = backend.app.test_client()
+
+	def tearDown(self):
+		self.database.command('dropDatabase')
+
+	# GET/POST path, returns the decoded json response
+	def get_json(self, path, code=200):
+		rv = self.client.get(path)
+		self.assertEqual(rv.status_code, code, '%s: %d %s' % (path, rv.status_code, rv.data))
+		return json.loads(rv.data) if rv.data else None
+
+	def post_json(self, path, data, code=200):
+		rv = self.client.post(path, data=json.dumps(data), content_type='application/json')
+		self.assertEqual(rv.status_code, code, '%s: %d %s' % (path, rv.status_code, rv.data))
+		return json.loads(rv.data)
+
+	# app store app, run and results posted via the api, each returns its id
+	def post_app(self, bundleId, genre='Games'):
+		if not self.db.Account.collection.find_one({'uniqueIdentifier': 'acc'}):
+			self.db.Account.collection.insert({'uniqueIdentifier': 'acc', 'appleId': 'acc@example.com', 'storeCountry': 'us'})
+		return self.post_json('/apps', {
+			'name': bundleId,
+			'bundleId': bundleId,
+			'version': '1.0',
+			'trackId': 1,
+			'account': 'acc',
+			'primaryGenreName': genre
+		})['appId']
+
+	def post_run(self, appId, executionStrategy='RandomExecution', **data):
+		data.update({'app': appId, 'executionStrategy': executionStrategy})
+		return self.post_json('/runs', data)['runId']
+
+	def post_result(self, runId, resultType, data):
+		return self.post_json('/results', {'run': runId, 'resultInfo': {'type': resultType, 'data': data}})['resultId']
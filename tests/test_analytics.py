@@ -0,0 +1,70 @@
+# coverage, tracking libs and http requests served from the aggregates
+# maintained by post_results (see documents.StrategyAggregate)
+#	usage: python -m unittest discover tests (see backend_test)
+
+import unittest
+
+from bson.objectid import ObjectId
+
+from backend_test import BackendTestCase, backend
+from documents import Result
+
+
+def http_request(i):
+	return {'url': 'https://tracker.example.com/%d' % i, 'method': 'GET'}
+
+
+class AnalyticsTest(BackendTestCase):
+
+	def setUp(self):
+		super(AnalyticsTest, self).setUp()
+		self.appId = self.post_app('com.example.app')
+		self.runId = self.post_run(self.appId)
+		self.post_result(self.runId, Result.TYPE.COVERAGE, '10/100')
+		self.post_result(self.runId, Result.TYPE.COVERAGE, '20/100')
+		self.post_result(self.runId, Result.TYPE.TRACKING_LIBS, ['lib1', 'lib2'])
+		self.post_result(self.runId, Result.TYPE.TRACKING_LIBS, ['lib2', 'lib3'])
+		self.post_result(self.runId, Result.TYPE.HTTP_REQUESTS, [http_request(1), http_request(2), http_request(1)])
+		self.post_result(self.runId, Result.TYPE.HTTP_REQUESTS, [http_request(2), http_request(3)])
+
+	def get_strategies(self, path, field):
+		return dict(((entry['bundleId'], entry['executionStrategy']), entry[field]) for entry in self.get_json(path))
+
+	def assertAnalytics(self, bundleId='com.example.app', executionStrategy='RandomExecution'):
+		key = (bundleId, executionStrategy)
+		self.assertEqual(self.get_strategies('/results/coverage', 'coverage'), {key: 0.2})
+		self.assertEqual(sorted(self.get_strategies('/results/trackinglibs', 'tracking_libs')[key]), ['lib1', 'lib2', 'lib3'])
+		# distinct requests in the order they were first reported
+		self.assertEqual(self.get_strategies('/results/httprequests', 'http_requests'), {key: [http_request(1), http_request(2), http_request(3)]})
+		self.assertEqual(self.db.StrategyHttpRequest.collection.find().count(), 3)
+
+	def test_merged_on_post(self):
+		self.assertAnalytics()
+
+	def test_ndjson(self):
+		rv = self.client.get('/results/httprequests?format=ndjson')
+		self.assertEqual(rv.status_code, 200)
+		self.assertEqual(len(rv.data.splitlines()), 1)
+
+	def test_rebuild(self):
+		# manage connects on import like the backend
+		import manage
+		manage.rebuild_rollups(None)
+		self.assertAnalytics()
+		self.db.StrategyRollup.collection.remove({})
+		self.db.StrategyHttpRequest.collection.remove({})
+		self.assertEqual(self.db.StrategyHttpRequest.rebuild(self.db, [ObjectId(self.appId)]), 3)
+		self.assertEqual(self.db.StrategyRollup.rebuild(self.db, [ObjectId(self.appId)]), 1)
+		backend.results_changed()
+		self.assertAnalytics()
+
+	def test_run_moved(self):
+		# the results follow their run to another app and strategy
+		otherId = self.post_app('com.example.other')
+		self.post_json('/runs', {'_id': self.runId, 'app': otherId, 'executionStrategy': 'SmartExecution3'})
+		self.assertAnalytics('com.example.other', 'SmartExecution3')
+		self.assertEqual(len(self.get_json('/results/coverage')), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,84 @@
+# ipas and result binaries stored content addressed (see documents.Blob)
+#	usage: python -m unittest discover tests (see backend_test)
+
+import base64
+import hashlib
+import unittest
+from StringIO import StringIO
+
+from backend_test import BackendTestCase
+from documents import Result
+
+
+class BlobsTest(BackendTestCase):
+
+	def post_ipa(self, appId, content, code=200):
+		rv = self.client.post('/apps/%s/ipa' % appId, data={'ipa': (StringIO(content), 'app.ipa')})
+		self.assertEqual(rv.status_code, code, rv.data)
+
+	def test_ipa(self):
+		appId = self.post_app('com.example.app')
+		otherId = self.post_app('com.example.other')
+		self.assertEqual(self.client.get('/apps/%s/ipa' % appId).status_code, 404)
+
+		self.post_ipa(appId, 'ipa content')
+		self.post_ipa(appId, 'ipa content', code=400)
+		self.post_ipa(otherId, 'ipa content')
+		for objid in (appId, otherId):
+			rv = self.client.get('/apps/%s/ipa' % objid)
+			self.assertEqual(rv.status_code, 200)
+			self.assertEqual(rv.data, 'ipa content')
+		# the same content is stored once
+		blobs = list(self.db.Blob.collection.find())
+		self.assertEqual(len(blobs), 1)
+		self.assertEqual(len(blobs[0]['refs']), 2)
+
+		self.assertEqual(self.client.delete('/apps/%s/ipa' % appId).status_code, 200)
+		self.assertEqual(self.client.get('/apps/%s/ipa' % appId).status_code, 404)
+		self.assertEqual(self.client.get('/apps/%s/ipa' % otherId).data, 'ipa content')
+		# the content is removed with its last name
+		self.assertEqual(self.client.delete('/apps/%s/ipa' % otherId).status_code, 200)
+		self.assertEqual(self.db.Blob.collection.find().count(), 0)
+		self.assertEqual(self.db.App.collection.database['apps.files'].find().count(), 0)
+
+	def test_ipa_upload(self):
+		appId = self.post_app('com.example.app')
+		content = 'x' * 100
+		upload = self.post_json('/apps/%s/ipa/uploads' % appId, {'sha256': hashlib.sha256(content).hexdigest(), 'length': len(content)})
+		path = '/apps/%s/ipa/uploads/%s' % (appId, upload['uploadId'])
+		for offset in (0, 60):
+			rv = self.client.put('%s?offset=%d' % (path, offset), data=content[offset:offset + 60], content_type='application/octet-stream')
+			self.assertEqual(rv.status_code, 200, rv.data)
+		self.assertEqual(self.get_json(path)['offset'], len(content))
+		self.post_json(path + '/finalize', {})
+		self.assertEqual(self.client.get('/apps/%s/ipa' % appId).data, content)
+
+	def test_ipa_upload_form_content_type(self):
+		# curl --data-binary sends the chunk as application/x-www-form-urlencoded
+		appId = self.post_app('com.example.app')
+		content = 'a=1&b=2'
+		upload = self.post_json('/apps/%s/ipa/uploads' % appId, {'sha256': hashlib.sha256(content).hexdigest(), 'length': len(content)})
+		path = '/apps/%s/ipa/uploads/%s' % (appId, upload['uploadId'])
+		rv = self.client.put(path + '?offset=0', data=content, content_type='application/x-www-form-urlencoded')
+		self.assertEqual(rv.status_code, 200, rv.data)
+		self.assertEqual(self.get_json(path)['offset'], len(content))
+		self.post_json(path + '/finalize', {})
+		self.assertEqual(self.client.get('/apps/%s/ipa' % appId).data, content)
+
+	def test_result_binary(self):
+		runId = self.post_run(self.post_app('com.example.app'))
+		resultId = self.post_result(runId, Result.TYPE.APP_ARCHIVE, base64.b64encode('archive'))
+		rv = self.client.get('/results/%s/binary' % resultId)
+		self.assertEqual(rv.status_code, 200)
+		self.assertEqual(rv.data, 'archive')
+
+		self.assertEqual(self.client.delete('/results/%s/binary' % resultId).status_code, 200)
+		self.assertEqual(self.client.get('/results/%s/binary' % resultId).status_code, 404)
+
+	def test_required_index(self):
+		keys = [index['key'] for index in self.db.Blob.collection.index_information().values()]
+		self.assertIn([('store', 1), ('sha256', 1)], keys)
+
+
+if __name__ == '__main__':
+	unittest.main()
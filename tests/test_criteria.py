@@ -0,0 +1,48 @@
+# per-app criteria summaries (see documents.CriteriaSummary)
+#	usage: python -m unittest discover tests (see backend_test)
+
+import unittest
+
+from bson.objectid import ObjectId
+
+from backend_test import BackendTestCase
+from documents import Result
+
+
+class CriteriaSummaryTest(BackendTestCase):
+
+	def setUp(self):
+		super(CriteriaSummaryTest, self).setUp()
+		self.appId = self.post_app('com.example.app')
+		self.runIds = [self.post_run(self.appId, executionStrategy) for executionStrategy in ('RandomExecution', 'SmartExecution3')]
+		self.resultIds = [
+			self.post_result(self.runIds[0], Result.TYPE.CRITERIA, {'usesNetwork': False, 'flags': 1}),
+			self.post_result(self.runIds[1], Result.TYPE.CRITERIA, {'usesNetwork': True, 'flags': 4}),
+		]
+
+	def assertSummary(self):
+		summary = self.get_json('/results/criteria/grouped')[self.appId]
+		self.assertEqual(summary['criteria'], {'usesNetwork': True, 'flags': 5})
+		self.assertEqual(sorted(summary['results']), sorted(self.resultIds))
+		self.assertEqual(sorted(summary['runs']), sorted(self.runIds))
+		self.assertEqual(self.db.CriteriaSummary.collection.find().count(), 1)
+
+	def test_merged_on_post(self):
+		self.assertSummary()
+
+	def test_merged_once(self):
+		result = self.db.Result.collection.find_one({'_id': ObjectId(self.resultIds[0])})
+		self.db.CriteriaSummary.add_result(ObjectId(self.appId), result['run'].id, result['_id'], result['resultInfo']['data'])
+		self.assertSummary()
+
+	def test_rebuild(self):
+		# the results are recent, so all of them are merged again by the rebuild
+		self.db.CriteriaSummary.collection.remove({})
+		self.assertEqual(self.db.CriteriaSummary.rebuild(self.db), 1)
+		self.assertSummary()
+		self.assertEqual(self.db.CriteriaSummary.rebuild(self.db, [self.db.App.collection.find_one()['_id']]), 1)
+		self.assertSummary()
+
+
+if __name__ == '__main__':
+	unittest.main()
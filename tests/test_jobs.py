@@ -0,0 +1,78 @@
+# posting jobs and claiming them via getandsetworker
+#	usage: python -m unittest discover tests (see backend_test)
+
+import threading
+import time
+import unittest
+
+from backend_test import BackendTestCase, backend, ref
+from documents import Job
+
+
+class JobsTest(BackendTestCase):
+
+	def setUp(self):
+		super(JobsTest, self).setUp()
+		accountId = self.db.Account.collection.insert({'uniqueIdentifier': 'acc', 'appleId': 'acc@example.com', 'storeCountry': 'us'})
+		self.workerId = self.db.Worker.collection.insert({'name': 'worker'})
+		for udid in ('device', 'other'):
+			self.db.Device.collection.insert({'udid': udid, 'deviceInfo': {'model': 'iPhone'}, 'accounts': [ref('accounts', accountId)]})
+
+	def job_data(self, bundleId):
+		return {'type': Job.TYPE.RUN_APP, 'state': Job.STATE.PENDING, 'jobInfo': {'bundleId': bundleId}}
+
+	def claim_path(self, udid, wait=0):
+		return '/jobs/getandsetworker/%s/device/%s?wait=%d' % (self.workerId, udid, wait)
+
+	def test_post_and_claim(self):
+		jobId = self.post_json('/jobs', self.job_data('com.example.app'))['jobId']
+
+		job = self.get_json(self.claim_path('device'))
+		self.assertEqual(job['_id'], jobId)
+		self.assertEqual(job['worker'], str(self.workerId))
+		self.assertEqual(job['device'], 'device')
+		# the unfinished job stays with its device
+		self.assertEqual(self.get_json(self.claim_path('device'))['_id'], jobId)
+		self.get_json(self.claim_path('other'), code=204)
+
+	def test_post_list_and_claim(self):
+		rv = self.post_json('/jobs', [self.job_data('com.example.app1'), self.job_data('com.example.app2')])
+		jobIds = set(item['jobId'] for item in rv['jobs'])
+		self.assertEqual(len(jobIds), 2)
+
+		claimed = set()
+		for udid in ('device', 'other'):
+			claimed.add(self.get_json(self.claim_path(udid))['_id'])
+		self.assertEqual(claimed, jobIds)
+
+	def test_post_increases_counter(self):
+		self.assertEqual(self.db.Counter.get_value('jobs'), 0)
+		self.post_json('/jobs', self.job_data('com.example.app'))
+		self.post_json('/jobs', [self.job_data('com.example.app1')])
+		self.assertEqual(self.db.Counter.get_value('jobs'), 2)
+
+	def test_claim_without_job(self):
+		self.get_json(self.claim_path('device'), code=204)
+		start = time.time()
+		self.get_json(self.claim_path('device', wait=1), code=204)
+		self.assertGreaterEqual(time.time() - start, 1)
+
+	def test_wait_for_job(self):
+		# a job posted while the worker waits is claimed right away
+		def post_job():
+			time.sleep(0.5)
+			with backend.app.app_context():
+				backend.app.test_client().post('/jobs', data=backend.jd(self.job_data('com.example.app')), content_type='application/json')
+		thread = threading.Thread(target=post_job)
+		thread.start()
+		try:
+			start = time.time()
+			job = self.get_json(self.claim_path('device', wait=10))
+			self.assertLess(time.time() - start, 5)
+			self.assertEqual(job['jobInfo']['bundleId'], 'com.example.app')
+		finally:
+			thread.join()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,107 @@
+# the number of queries of the list routes must not grow with the number
+# of referenced documents (see response_doc_query): the routes are called
+# for the same number of documents with a few and with many references
+#	usage: python -m unittest discover tests (see backend_test)
+
+import unittest
+
+from backend_test import BackendTestCase, ref
+from documents import Job, Result
+
+
+class QueryCountTest(BackendTestCase):
+
+	def tearDown(self):
+		self.database.set_profiling_level(0)
+		super(QueryCountTest, self).tearDown()
+
+	# number of queries (including getmores) made by a GET of path
+	def count_queries(self, path):
+		self.database.set_profiling_level(0)
+		self.database.system.profile.drop()
+		self.database.set_profiling_level(2)
+		try:
+			rv = self.client.get(path)
+			self.assertEqual(rv.status_code, 200)
+			# the streamed responses query while the body is read
+			rv.get_data()
+		finally:
+			self.database.set_profiling_level(0)
+		return self.database.system.profile.find({
+			'op': {'$in': ['query', 'getmore']},
+			'ns': {'$ne': '%s.system.profile' % self.database.name}
+		}).count()
+
+	# jobs with their own worker and device, each device with refs accounts
+	def seed_jobs(self, refs, jobs=10):
+		db = self.db
+		accountIds = [db.Account.collection.insert({'uniqueIdentifier': 'acc%d' % i, 'appleId': 'acc%d@example.com' % i}) for i in range(refs)]
+		for i in range(jobs):
+			workerId = db.Worker.collection.insert({'name': 'worker%d' % i})
+			deviceId = db.Device.collection.insert({
+				'udid': 'device%d' % i,
+				'accounts': [ref('accounts', accountId) for accountId in accountIds]
+			})
+			db.Job.collection.insert({
+				'type': Job.TYPE.RUN_APP,
+				'state': Job.STATE.PENDING,
+				'jobInfo': {'bundleId': 'com.example.app%d' % i},
+				'worker': ref('workers', workerId),
+				'device': ref('devices', deviceId),
+				'date_added': float(i)
+			})
+
+	# results spread over refs runs, each of its own app store app
+	def seed_results(self, refs, results=20):
+		db = self.db
+		runIds = []
+		for i in range(refs):
+			accountId = db.Account.collection.insert({'uniqueIdentifier': 'acc%d' % i, 'appleId': 'acc%d@example.com' % i})
+			appId = db.App.collection.insert({
+				'type': 'AppStoreApp',
+				'name': 'app%d' % i,
+				'bundleId': 'com.example.app%d' % i,
+				'version': '1.0',
+				'account': ref('accounts', accountId)
+			})
+			runIds.append(db.Run.collection.insert({'app': ref('apps', appId), 'executionStrategy': 'RandomExecution'}))
+		for i in range(results):
+			db.Result.collection.insert({
+				'run': ref('runs', runIds[i % refs]),
+				'resultInfo': {'type': Result.TYPE.STRING, 'data': 'result %d' % i}
+			})
+
+	def assertConstantQueries(self, seed, path):
+		counts = []
+		for refs in (1, 10):
+			self.database.command('dropDatabase')
+			seed(refs)
+			counts.append(self.count_queries(path))
+		self.assertEqual(counts[0], counts[1], 'queries of %s: %s' % (path, counts))
+
+	def test_jobs(self):
+		self.assertConstantQueries(self.seed_jobs, '/jobs')
+
+	def test_jobs_page(self):
+		self.assertConstantQueries(self.seed_jobs, '/jobs?limit=50')
+
+	def test_results(self):
+		self.assertConstantQueries(self.seed_results, '/results')
+
+	def test_results_page(self):
+		self.assertConstantQueries(self.seed_results, '/results?limit=50')
+
+	def test_job(self):
+		self.seed_jobs(10)
+		jobId = self.db.Job.collection.find_one()['_id']
+		# the job and the udid of its device
+		self.assertEqual(self.count_queries('/jobs/%s' % jobId), 2)
+
+	def test_result(self):
+		self.seed_results(10)
+		resultId = self.db.Result.collection.find_one()['_id']
+		self.assertEqual(self.count_queries('/results/%s' % resultId), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
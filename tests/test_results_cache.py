@@ -0,0 +1,55 @@
+# the analytics routes are cached until results, runs or apps are posted
+# (see cached_results)
+#	usage: python -m unittest discover tests (see backend_test)
+
+import unittest
+
+from backend_test import BackendTestCase
+from documents import Result
+
+
+class ResultsCacheTest(BackendTestCase):
+
+	def stacktraces(self):
+		return dict((entry['bundleId'], entry) for entry in self.get_json('/results/stacktraces'))
+
+	def test_cached_until_write(self):
+		appId = self.post_app('com.example.app')
+		runId = self.post_run(appId)
+		self.post_result(runId, Result.TYPE.STACKTRACE, {'crash': ['frame 1']})
+		before = self.stacktraces()
+		self.assertIn('com.example.app', before)
+		# served from the cache
+		self.assertEqual(self.stacktraces(), before)
+
+		self.post_result(runId, Result.TYPE.STACKTRACE, {'hang': ['frame 2']})
+		after = self.stacktraces()
+		self.assertNotEqual(after, before)
+
+		runId = self.post_run(self.post_app('com.example.other'))
+		self.post_result(runId, Result.TYPE.STACKTRACE, {'crash': ['frame 3']})
+		self.assertIn('com.example.other', self.stacktraces())
+
+	def test_not_modified(self):
+		self.post_run(self.post_app('com.example.app'))
+		rv = self.client.get('/results/coverage')
+		self.assertEqual(rv.status_code, 200)
+		etag = rv.headers['ETag']
+		rv = self.client.get('/results/coverage', headers={'If-None-Match': etag})
+		self.assertEqual(rv.status_code, 304)
+
+		self.post_run(self.post_app('com.example.other'))
+		rv = self.client.get('/results/coverage', headers={'If-None-Match': etag})
+		self.assertEqual(rv.status_code, 200)
+
+	def test_analytics_routes(self):
+		runId = self.post_run(self.post_app('com.example.app'))
+		self.post_result(runId, Result.TYPE.CRITERIA, {'usesNetwork': True})
+		for path in ('/results/coverage', '/results/trackinglibs', '/results/httprequests', '/results/stacktraces', '/results/criteria'):
+			self.get_json(path)
+			# cached
+			self.get_json(path)
+
+
+if __name__ == '__main__':
+	unittest.main()